@@ -12,6 +12,7 @@ port = 8000
 admin_user =
 admin_pass =
 max_threads = 4
+max_batch_size = 500
 debug = 0
 
 [backend:main]
@@ -23,6 +24,17 @@ user = sitebase
 password = sitebase
 database = sitebase
 max_connections = 5
+plan_cache_size = 512
+prepare_statements = 1
+max_prepared_statements = 256
+result_cache_size = 64
+reference_cache_size = 0
+statement_timeout = 30000
+rebuild_workers = 3
+rebuild_batch_size = 200
+async_cache = 0
+cache_queue_workers = 2
+max_exports = 2
 
 [extra]
 field = etc/field.yaml
@@ -2,7 +2,8 @@
 __all__ = ["ManifestNotFound", "NullValueError", "UniqueValueError",
            "ValidationError", "ReferenceNotFound", "DataIntegrityError",
            "NodeNotFound", "NodeInUseError", "EmptyInputData",
-           "SearchGrammarError", "DatabaseError"]
+           "SearchGrammarError", "InvalidCursor", "QueryTimeout",
+           "SearchNotFound", "JobNotFound", "DatabaseError"]
 
 
 class GenericError(Exception):
@@ -195,3 +196,19 @@ class EmptyInputData(GenericError):
 
 class SearchGrammarError(GenericError):
     pass
+
+
+class InvalidCursor(GenericError):
+    pass
+
+
+class QueryTimeout(GenericError):
+    pass
+
+
+class SearchNotFound(GenericError):
+    pass
+
+
+class JobNotFound(GenericError):
+    pass
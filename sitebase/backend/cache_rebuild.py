@@ -0,0 +1,102 @@
+from twisted.internet import defer, task
+
+from ysl.twisted.log import debug, info, warn
+
+import time
+
+__all__ = ["CacheRebuild"]
+
+
+class CacheRebuild(object):
+    """
+    A bulk rebuild of node caches.
+
+    The node ids are cut into batches of batch_size, each rebuilt and
+    committed in a transaction of its own by run_batch(ids), which fires
+    with the number of caches written. workers batches are in flight at
+    a time, each on a pooled connection of its own: the workers pull the
+    next batch from a shared iterator as they get done, so a slow batch
+    does not hold the others back.
+    """
+
+    MAX_ERRORS = 10
+
+    def __init__(self, job_id, run_batch, ids, workers=3, batch_size=200,
+                 description=None):
+        self.job_id = job_id
+        self.run_batch = run_batch
+        self.ids = ids
+        self.workers = max(1, min(workers, len(ids) or 1))
+        self.batch_size = max(1, batch_size)
+        self.description = description
+        self.state = "pending"
+        self.done, self.failed, self.affected = 0, 0, 0
+        self.errors = list()
+        self.startTime, self.endTime = None, None
+        self.stopped = False
+
+    def _batches(self):
+        for i in xrange(0, len(self.ids), self.batch_size):
+            if self.stopped:
+                return
+            yield self.ids[i:i + self.batch_size]
+
+    def _work(self, batches):
+        for ids in batches:
+            d = self.run_batch(ids)
+            d.addCallbacks(self._batch_done, self._batch_failed,
+                           callbackArgs=(ids, ), errbackArgs=(ids, ))
+            yield d
+
+    def _batch_done(self, affected, ids):
+        self.done += len(ids)
+        self.affected += affected
+        debug("rebuild %d: %d of %d" % (self.job_id, self.done + self.failed,
+                                        len(self.ids)))
+
+    def _batch_failed(self, err, ids):
+        self.failed += len(ids)
+        message = "ids %d..%d: %s" % (ids[0], ids[-1], err.getErrorMessage())
+        warn("rebuild %d: %s" % (self.job_id, message))
+        self.errors = (self.errors + [message])[-self.MAX_ERRORS:]
+
+    def start(self):
+        """Start the workers; fires with status() once all of them are done."""
+        info("rebuild %d: %d caches, %d workers, batches of %d"
+             % (self.job_id, len(self.ids), self.workers, self.batch_size))
+        self.state, self.startTime = "running", time.time()
+        cooperator, batches = task.Cooperator(), self._batches()
+        d = defer.DeferredList(map(
+            lambda x: cooperator.coiterate(self._work(batches)),
+            range(self.workers)))
+        d.addCallback(self._finished)
+        return d
+
+    def _finished(self, result):
+        self.endTime = time.time()
+        self.state = ("done", "stopped")[self.stopped]
+        status = self.status()
+        info("rebuild %d %s: %d done, %d failed in %.1fs"
+             % (self.job_id, self.state, self.done, self.failed,
+                status["elapsed"]))
+        return status
+
+    def stop(self):
+        """Let the batches in flight finish and start no further ones."""
+        if self.state in ("pending", "running"):
+            self.stopped = True
+
+    def status(self):
+        elapsed = self.startTime and ((self.endTime or time.time())
+                                      - self.startTime) or 0
+        rate = elapsed and (self.done + self.failed) / elapsed or 0
+        left = len(self.ids) - self.done - self.failed
+        return dict(id=self.job_id, state=self.state,
+                    description=self.description, total=len(self.ids),
+                    done=self.done, failed=self.failed,
+                    affected=self.affected, workers=self.workers,
+                    batch_size=self.batch_size, elapsed=round(elapsed, 3),
+                    rate=round(rate, 1),
+                    eta=(self.state == "running" and rate and
+                         round(left / rate, 1) or None),
+                    errors=self.errors)
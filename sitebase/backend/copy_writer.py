@@ -0,0 +1,33 @@
+from twisted.internet.threads import blockingCallFromThread
+
+__all__ = ["CopyWriter"]
+
+
+class CopyWriter(object):
+    """
+    File-like target for COPY ... TO STDOUT running in a thread. The
+    output is handed to target() on the reactor in chunks of about size
+    bytes; when target() returns a Deferred, the thread, and with it the
+    COPY, waits until it fires, so a slow client slows the export down
+    instead of piling it up in memory.
+    """
+
+    def __init__(self, target, size=65536):
+        self.target = target
+        self.size = size
+        self.buffer = list()
+        self.buffered = 0
+
+    def write(self, data):
+        self.buffer.append(data)
+        self.buffered += len(data)
+        if self.buffered >= self.size:
+            self.flush()
+
+    def flush(self):
+        if not self.buffer:
+            return
+        from twisted.internet import reactor
+        data = "".join(self.buffer)
+        self.buffer, self.buffered = list(), 0
+        blockingCallFromThread(reactor, self.target, data)
@@ -0,0 +1,117 @@
+__all__ = ["IndexAdvisor"]
+
+
+class IndexAdvisor(object):
+    """
+    Records the (field, operator) predicates searches are made of, with
+    how often and how slowly they run, and derives the node_cache indexes
+    that workload needs. Index names follow tools/create_index, so the
+    advice can be checked against what the database already has.
+    """
+
+    # operators no expression index can serve
+    UNINDEXED = ("!=", "!==", "!~")
+
+    # created by tools/create_index for every database: node lookups by
+    # id, cache rebuilds by depends and === need them whether or not the
+    # searches recorded here ran into them
+    BASE = ("idx_auto_cache_id", "idx_auto_cache_manifest",
+            "idx_auto_cache_manifest_i", "idx_auto_cache_cn",
+            "idx_auto_cache_cn_i", "idx_auto_cache_value_gin",
+            "idx_auto_cache_depends_gin")
+
+    def __init__(self, searchable=(), types=None, max_predicates=4096):
+        self.searchable = searchable
+        self.types = types or dict()
+        self.max_predicates = max_predicates
+        self.predicates = dict()
+
+    def record(self, predicates, duration):
+        for predicate in set(predicates):
+            counter = self.predicates.get(predicate)
+            if counter is None:
+                # field names come from clients, keep the table bounded
+                if len(self.predicates) >= self.max_predicates:
+                    continue
+                counter = self.predicates[predicate] = [0, 0.0, 0.0]
+            counter[0] += 1
+            counter[1] += duration
+            counter[2] = max(counter[2], duration)
+
+    def index(self, field, operator):
+        """Return (name, DDL) of the index serving a predicate, or None."""
+        if field == "id" or operator in self.UNINDEXED:
+            return None
+        if operator == "===" and field not in ("manifest", "cn"):
+            # hstore containment, see _conjunction
+            return ("idx_auto_cache_value_gin",
+                    "CREATE INDEX idx_auto_cache_value_gin ON node_cache "
+                    "USING GIN (value);")
+        if field in ("manifest", "cn"):
+            d = dict(name=field, expr=field, prefix="idx_auto_cache_")
+        else:
+            quoted = field.replace("\\", "\\\\").replace("'", "\\'")
+            d = dict(name=quoted, expr="value->E'%s'" % quoted,
+                     prefix="idx_auto_cache_value_")
+        if operator in ("<", "<=", ">", ">=") and field in self.types:
+            # typed comparison, see _build_where_clause
+            d["type"] = self.types[field]
+            name = "%(prefix)s%(type)s_%(name)s" % d
+            ddl = "CREATE INDEX %%s ON node_cache ((sitebase_to_%s(%%s)));" \
+                % d["type"]
+        elif operator == "~" or (operator == "^" and
+                                 field in self.searchable):
+            # ILIKE, see _build_where_clause
+            name = "%(prefix)strgm_%(name)s" % d
+            ddl = ("CREATE INDEX %s ON node_cache USING GIN "
+                   "((%s) gin_trgm_ops);")
+        elif operator in ("==", "IN"):
+            name = "%(prefix)s%(name)s_i" % d
+            ddl = "CREATE INDEX %s ON node_cache (lower(%s));"
+        elif operator == "^":
+            name = "%(prefix)stext_%(name)s_i" % d
+            ddl = ("CREATE INDEX %s ON node_cache USING BTREE "
+                   "(lower(%s) text_pattern_ops);")
+        else:
+            name = "%(prefix)s%(name)s" % d
+            ddl = "CREATE INDEX %s ON node_cache ((%s));"
+        return name, ddl % (name, d["expr"])
+
+    def stats(self):
+        stats = list()
+        for (field, operator), (count, total, slowest) in \
+                self.predicates.items():
+            stats.append(dict(field=field, operator=operator, count=count,
+                              total=total * 1000, max=slowest * 1000,
+                              index=(self.index(field, operator) or
+                                     (None,))[0]))
+        stats.sort(key=lambda x: x["total"], reverse=True)
+        return stats
+
+    def advise(self, existing, min_count=1):
+        """
+        Compare the workload with the existing auto indexes, a dict of
+        name => (table, scans), and return the statements to create the
+        missing indexes and to drop the node_cache ones nothing uses,
+        leaving the BASE ones alone.
+        """
+        wanted = dict()
+        for predicate, (count, total, slowest) in self.predicates.items():
+            index = self.index(*predicate)
+            if index and count >= min_count:
+                name, ddl = index
+                wanted[name] = (ddl, wanted.get(name, (None, 0.0))[1] + total)
+
+        # costliest first, so the list can be applied from the top
+        create = map(lambda x: wanted[x][0],
+                     sorted(filter(lambda x: x not in existing, wanted),
+                            key=lambda x: wanted[x][1], reverse=True))
+        if filter(lambda x: "gin_trgm_ops" in x, create):
+            create.insert(0, "CREATE EXTENSION IF NOT EXISTS pg_trgm;")
+        drop = map(lambda x: "DROP INDEX %s;" % x,
+                   sorted(filter(lambda x: existing[x][0] == "node_cache"
+                                 and not existing[x][1]
+                                 and x not in wanted
+                                 and x not in self.BASE,
+                                 existing)))
+        return dict(create=create, drop=drop)
@@ -1,12 +1,28 @@
 from txpostgres import txpostgres
-from twisted.internet import defer
+from twisted.internet import defer, threads
 from twisted.internet.defer import DeferredList
-from collections import namedtuple, defaultdict
+from collections import namedtuple
+from decimal import Decimal, InvalidOperation
+from itertools import izip
 
 from sitebase import backend, slex
+from sitebase.backend.cache_rebuild import CacheRebuild
+from sitebase.backend.copy_writer import CopyWriter
+from sitebase.backend.index_advisor import IndexAdvisor
+from sitebase.backend.query_guard import QueryGuard
+from sitebase.backend.rebuild_queue import RebuildQueue
+from sitebase.backend.reference_cache import ReferenceCache
+from sitebase.backend.result_cache import ResultCache
 from ysl.twisted.log import debug, warn
+from ysl.util import LRUCache
+from ujson import decode as json_decode, encode as json_encode
 
+import base64
+import hashlib
+import itertools
+import psycopg2
 import re
+import socket
 import time
 
 # FIXES:
@@ -18,6 +34,8 @@ def _debug(*argv, **kwargs):
     print ">" * 40, argv
 
 NodeValue = namedtuple("NodeValue", ["field", "value", "referer"])
+SearchPlan = namedtuple("SearchPlan", ["where_clause", "params", "manifests",
+                                       "predicates"])
 
 
 class PostgresBackend(object):
@@ -26,6 +44,15 @@ class PostgresBackend(object):
 
     RE_EXPAND_VAR = re.compile("%{([a-zA-Z0-9._-]+)}")
 
+    RE_PLACEHOLDER = re.compile("%(%|s)")
+
+    RE_PLAN_ROWS = re.compile("rows=([0-9]+)")
+
+    # field types of field.yaml and the SQL types their values compare
+    # as, through the sitebase_to_<type>() functions of tools/create_index
+    FIELD_TYPES = dict(date="date", int="bigint", decimal="numeric",
+                       inet="inet")
+
     SQL_CHECK_UNIQUE = "SELECT count(1) FROM nodes WHERE manifest = \
 %(manifest)s AND lower(value->%(field)s) = lower(%(value)s) LIMIT 1"
 
@@ -43,6 +70,15 @@ VALUES(%(cn)s, %(manifest)s, %(value)s)"
                                                manifest, value, depends) \
 VALUES(%(id)s, %(cn)s, %(manifest)s, %(value)s, %(depends)s)"
 
+    # rewrite a cache row only when its content changed; tells whether it
+    # was rewritten and whether there was a row at all
+    SQL_UPDATE_CACHE_CHANGED = "WITH updated AS (UPDATE node_cache \
+SET cn = %(cn)s, manifest = %(manifest)s, value = %(value)s, \
+depends = %(depends)s WHERE id = %(id)s AND (cn, manifest, value, depends) \
+IS DISTINCT FROM (%(cn)s, %(manifest)s, %(value)s::hstore, %(depends)s) \
+RETURNING id) SELECT (SELECT count(1) FROM updated), \
+EXISTS (SELECT 1 FROM node_cache WHERE id = %(id)s)"
+
     SQL_GET_LAST_ID = "SELECT currval('nodes_id_seq')"
 
     SQL_UPDATE_NODE = "UPDATE nodes SET value = value || %(value)s, \
@@ -63,33 +99,125 @@ WHERE id = %(id)s LIMIT 1"
 ('.cn=>"' || replace(cn, '"', '\\\\"') || '"')::hstore \
 FROM nodes WHERE id = %(id)s LIMIT 1))"""
 
+    # nodes and every node they reference, directly or not, in one go;
+    # UNION stops at nodes already seen, known ones are not fetched again
+    SQL_SELECT_NODE_TREE = """WITH RECURSIVE tree(id) AS ( \
+SELECT unnest(%(id)s::bigint[]) UNION \
+SELECT substr(r, 2)::bigint FROM tree JOIN nodes USING (id), \
+unnest(nodes.value -> %(references)s::text[]) AS r \
+WHERE r ~ '^@[0-9]+$' AND NOT tree.id = ANY(%(known)s::bigint[])) \
+SELECT id, manifest, cn, akeys(value), avals(value) FROM nodes \
+WHERE id IN (SELECT id FROM tree) AND NOT id = ANY(%(known)s::bigint[])"""
+
     SQL_SELECT_CACHE = """SELECT key, value FROM each((SELECT value || \
 ('.id=>"' || id || '"')::hstore || \
 ('.manifest=>"' || replace(manifest, '"', '\\\\"') || '"')::hstore || \
 ('.cn=>"' || replace(cn, '"', '\\\\"') || '"')::hstore \
+FROM node_cache WHERE id = %(id)s LIMIT 1))"""
+
+    SQL_SELECT_CACHE_FIELDS = """SELECT key, value FROM each((SELECT \
+slice(value, %(fields)s) || \
+('.id=>"' || id || '"')::hstore || \
+('.manifest=>"' || replace(manifest, '"', '\\\\"') || '"')::hstore || \
+('.cn=>"' || replace(cn, '"', '\\\\"') || '"')::hstore \
 FROM node_cache WHERE id = %(id)s LIMIT 1))"""
 
     SQL_DELETE_NODE = "DELETE FROM nodes WHERE id = ANY(%(id)s)"
 
-    SQL_DELETE_CACHE = "DELETE FROM node_cache WHERE id = ANY(%(id)s)"
+    SQL_DELETE_CACHE = "DELETE FROM node_cache WHERE id = ANY(%(id)s) \
+RETURNING manifest"
 
     SQL_SELECT_REFERERS = "SELECT id FROM nodes \
 WHERE manifest = ANY(%(referers)s) AND value->%(field)s = %(value)s"
 
-    SQL_SELECT_DEPENDS = "SELECT id FROM nodes \
-WHERE depends @> %(depends)s"
+    MAX_REBUILDS = 16
+
+    MAX_KNOWN_NODES = 256
+
+    SQL_SELECT_NODE_IDS = "SELECT id FROM nodes ORDER BY id"
+
+    SQL_SELECT_NODE_IDS_BY_MANIFEST = "SELECT id FROM nodes \
+WHERE manifest = ANY(%(manifest)s) ORDER BY id"
+
+    SQL_SELECT_CACHE_IDS = "SELECT id FROM node_cache \
+WHERE %(where_clause)s ORDER BY id"
 
-    SQL_SELECT_CACHE_EX = """SELECT id, (each(value)).key, \
-    (each(value)).value FROM (SELECT id, (value \
-    || ('.manifest=>\"' || replace(manifest, '"', '\\\\"') || '\"')::hstore \
-    || ('.cn=>\"' || replace(cn, '"', '\\\\"') || '\"')::hstore) AS value \
-    FROM node_cache WHERE %(where_clause)s \
-        ORDER BY %(order_by)s %(order)s NULLS FIRST \
-LIMIT %(limit)s OFFSET %(offset)s ) AS e"""
+    # caches embedding any of the given nodes, served by the GIN index on
+    # node_cache.depends
+    SQL_SELECT_DEPENDENTS = "SELECT id FROM node_cache \
+WHERE depends && %(id)s"
+
+    SQL_SELECT_CACHE_EX = "SELECT id, manifest, cn, akeys(%(value)s), \
+avals(%(value)s), %(order_by)s, %(total)s FROM node_cache \
+WHERE %(where_clause)s \
+ORDER BY %(order_by)s %(order)s NULLS FIRST, id %(order)s \
+LIMIT %(limit)s OFFSET %%s"
 
     SQL_COUNT_CACHE_EX = "SELECT count(1) FROM node_cache \
 WHERE %(where_clause)s"
 
+    SQL_EXPLAIN_CACHE_EX = "EXPLAIN SELECT 1 FROM node_cache \
+WHERE %(where_clause)s"
+
+    SQL_FACET_CACHE_EX = "SELECT key, value, n FROM (SELECT key, value, \
+count(1) AS n, row_number() OVER (PARTITION BY key \
+ORDER BY count(1) DESC, value) AS rank FROM (SELECT key, CASE key \
+WHEN 'manifest' THEN manifest WHEN 'cn' THEN cn ELSE value->key END \
+AS value FROM node_cache, unnest(%%s::text[]) AS k(key) \
+WHERE %(where_clause)s) AS f GROUP BY key, value) AS g \
+WHERE %(top)s ORDER BY key, n DESC, value"
+
+    SQL_SELECT_AUTO_INDEXES = "SELECT indexrelname, relname, idx_scan \
+FROM pg_stat_user_indexes WHERE relname IN ('nodes', 'node_cache') \
+AND indexrelname LIKE 'idx\\_auto\\_%'"
+
+    SQL_SELECT_SAVED = "SELECT name, q, order_by, \"order\", total \
+FROM saved_search WHERE name = %(name)s"
+
+    SQL_LIST_SAVED = "SELECT name, q, order_by, \"order\", total \
+FROM saved_search ORDER BY name"
+
+    SQL_LOCK_SAVED = "SELECT 1 FROM saved_search WHERE name = %(name)s \
+FOR UPDATE"
+
+    SQL_CREATE_SAVED = "INSERT INTO saved_search(name, q, order_by, \
+\"order\") VALUES(%(name)s, %(q)s, %(order_by)s, %(order)s)"
+
+    SQL_DELETE_SAVED = "DELETE FROM saved_search WHERE name = %(name)s"
+
+    SQL_CLEAR_SAVED_RESULT = "DELETE FROM saved_search_result \
+WHERE name = %s"
+
+    SQL_FILL_SAVED_RESULT = "INSERT INTO saved_search_result(name, rank, id) \
+SELECT %%s, row_number() OVER (ORDER BY %(order_by)s %(order)s NULLS FIRST, \
+id %(order)s), id FROM node_cache WHERE %(where_clause)s"
+
+    SQL_UPDATE_SAVED = "UPDATE saved_search SET total = %s, \
+refreshed = now() WHERE name = %s"
+
+    SQL_SELECT_SAVED_RESULT = "SELECT c.id, c.manifest, c.cn, \
+akeys(%(value)s), avals(%(value)s) FROM saved_search_result r \
+JOIN node_cache c ON c.id = r.id WHERE r.name = %%s \
+ORDER BY r.rank LIMIT %(limit)s OFFSET %%s"
+
+    # one JSON object per line. COPY's text format would double the
+    # backslashes of the JSON; csv with a quote and delimiter that JSON
+    # never contains unescaped passes each line through as it is
+    SQL_EXPORT_NDJSON = "COPY (SELECT '{\".id\":' || id || ',\".manifest\":' \
+|| coalesce(to_json(manifest)::text, 'null') || ',\".cn\":' \
+|| coalesce(to_json(cn)::text, 'null') || CASE WHEN %(value)s = ''::hstore \
+THEN '}' ELSE ',' || substr(hstore_to_json(%(value)s)::text, 2) END \
+FROM node_cache WHERE %(where_clause)s) \
+TO STDOUT WITH (FORMAT csv, QUOTE E'\\x01', DELIMITER E'\\x02')"
+
+    SQL_EXPORT_CSV = "COPY (SELECT id, manifest, cn, %(columns)s \
+FROM node_cache WHERE %(where_clause)s) TO STDOUT WITH (FORMAT csv, HEADER)"
+
+    SQL_DECLARE_STREAM = "DECLARE sitebase_stream NO SCROLL CURSOR \
+FOR %(query)s"
+
+    SQL_FETCH_STREAM = "FETCH %(size)d FROM sitebase_stream"
+
     @staticmethod
     def _serialize_hstore(val):
         """
@@ -103,6 +231,7 @@ WHERE %(where_clause)s"
     def connect(self, *args, **kwargs):
         assert(self.pool == None)
         print args, "*"*60
+        self.connect_args = (args, kwargs)
         self.pool = txpostgres.ConnectionPool(None, *args, **kwargs)
         return self.pool.start()
 
@@ -110,6 +239,52 @@ WHERE %(where_clause)s"
         self.manifest = kwargs["manifest"]
         self.field = kwargs["field"]
         self.cache = kwargs["cache"]
+        self.cache_plans = dict()
+        for name, templates in self.cache.items():
+            self.cache_plans[name] = dict(map(
+                lambda x: (x[0], self._compile_template(x[1])),
+                templates.items()))
+        self.plans = LRUCache(kwargs.get("plan_cache_size", 512))
+        self.prepare = kwargs.get("prepare_statements", True)
+        self.max_prepared = kwargs.get("max_prepared_statements", 256)
+        self.prepared = dict()
+        # cursor -> write of ResultCache.begin() running on it
+        self.writes = dict()
+        self.results = ResultCache(kwargs.get("result_cache_size", 64 << 20))
+        self.referenced = ReferenceCache(
+            kwargs.get("reference_cache_size", 0))
+        self.statement_timeout = kwargs.get("statement_timeout", 0)
+        self.rebuild_workers = kwargs.get("rebuild_workers", 3)
+        self.rebuild_batch_size = kwargs.get("rebuild_batch_size", 200)
+        self.rebuilds = dict()
+        self.rebuild_ids = itertools.count(1)
+        self.async_cache = kwargs.get("async_cache", False)
+        self.rebuild_queue = RebuildQueue(
+            lambda *x: self._run_write(self._rebuild_queued, *x),
+            kwargs.get("cache_queue_workers", 2), self.rebuild_batch_size)
+        self.saved = dict()
+        # COPY runs on a reactor thread, keep some for the rest
+        self.exports = defer.DeferredSemaphore(
+            max(1, kwargs.get("max_exports", 2)))
+        self.searchable = set(filter(
+            lambda x: self.field[x].get("searchable") in ("1", 1, True),
+            self.field))
+        self.types = dict()
+        for name, properties in self.field.items():
+            if "type" not in properties:
+                continue
+            if properties["type"] in self.FIELD_TYPES:
+                self.types[name] = properties["type"]
+            else:
+                warn("unknown type %s of field %s" % (properties["type"],
+                                                      name))
+        self.advisor = IndexAdvisor(self.searchable, self.types)
+        # names a node cache value can have
+        self.value_fields = set(self.field)
+        for templates in self.cache.values():
+            self.value_fields.update(templates)
+        self.references = sorted(filter(
+            lambda x: "reference" in self.field[x], self.field))
 
         # build back reference
         self.backref = dict()
@@ -126,6 +301,59 @@ WHERE %(where_clause)s"
                                                    referers=list())
                     self.backref[refer]["referers"].append(name)
 
+    @defer.inlineCallbacks
+    def _run_write(self, interaction, *args, **kwargs):
+        """
+        runInteraction() for interactions writing nodes or caches. The
+        search results of the manifests they _bump() are not cached until
+        they are over.
+        """
+        write, cursors = self.results.begin(), list()
+
+        def _interaction(c, *args, **kwargs):
+            self.writes[c] = write
+            cursors.append(c)
+            return interaction(c, *args, **kwargs)
+
+        try:
+            result = yield self.pool.runInteraction(_interaction,
+                                                    *args, **kwargs)
+        finally:
+            for c in cursors:
+                self.writes.pop(c, None)
+            self.results.end(write)
+        defer.returnValue(result)
+
+    def _bump(self, c, manifests):
+        """Invalidate the search results of manifests written through c."""
+        self.results.bump(manifests, self.writes.get(c))
+
+    @defer.inlineCallbacks
+    def _run_node_write(self, node_ids, interaction, *args, **kwargs):
+        """
+        _run_write() for interactions writing the nodes node_ids, which
+        keeps them out of the referenced node cache meanwhile. Interactions
+        finding more nodes to write add them with self.referenced.writing()
+        and append them to node_ids.
+        """
+        self.referenced.writing(node_ids)
+        try:
+            result = yield self._run_write(interaction, *args, **kwargs)
+        finally:
+            self.referenced.written(node_ids)
+        defer.returnValue(result)
+
+    def guard(self):
+        """Return a QueryGuard bounded by the configured statement_timeout."""
+        return QueryGuard(self.statement_timeout)
+
+    def _run_guarded(self, guard, interaction, *args, **kwargs):
+        """runInteraction() under the deadline and cancellation of guard."""
+        if guard is None:
+            return self.pool.runInteraction(interaction, *args, **kwargs)
+        return self.pool.runInteraction(guard.run, interaction,
+                                        *args, **kwargs)
+
     def is_duplicated(self, node_id, manifest, field, value, create):
         data = dict(id=node_id, manifest=manifest, field=field,
                     value=value[field])
@@ -236,9 +464,9 @@ WHERE %(where_clause)s"
         defer.returnValue(relation)
 
     @defer.inlineCallbacks
-    def _do_upsert(self, c, relations, force_create):
+    def _do_upsert(self, c, relations, force_create, build=True):
         affected, cache_affected = 0, 0
-        node_cache = dict()
+        node_cache, written, updated = dict(), list(), list()
         debug("# of relations ready to process: %d" % len(relations))
         for node_id, relation in relations:
             if force_create:
@@ -254,14 +482,24 @@ WHERE %(where_clause)s"
                 result = yield c.execute(self.SQL_GET_LAST_ID)
                 id = result.fetchall()
                 node_id = id[0][0]
+            written.append(node_id)
+            node_cache.pop(node_id, None)
+            if s == self.SQL_UPDATE_NODE:
+                updated.append(node_id)
+            if not build:
+                continue
             cache = yield self._build_cache(c, node_id, node_cache)
             if cache["success"]:
                 cache_affected += cache["affected"]
         node_cache.clear()
-        defer.returnValue((affected, cache_affected))
+        if build and updated:
+            rebuilt = yield self._rebuild_dependents(c, updated)
+            cache_affected += rebuilt
+        defer.returnValue((affected, cache_affected, written, updated))
 
     @defer.inlineCallbacks
-    def upsert(self, input, force_create=False, check_only=False):
+    def upsert(self, input, force_create=False, check_only=False,
+               wait_cache=False):
         relations = list()
         errors = list()
 
@@ -315,14 +553,19 @@ WHERE %(where_clause)s"
         if check_only:
             defer.returnValue({"success": True})
 
-        (affected, cache_affected) = yield self.pool.runInteraction(
-            self._do_upsert, relations, force_create)
-        defer.returnValue(dict(success=True, affected=affected,
-                               cache=dict(success=True,
-                                          affected=cache_affected)))
+        (affected, cache_affected, written, updated) = \
+            yield self._run_node_write(
+                filter(None, map(lambda x: x[0], relations)),
+                self._do_upsert, relations, force_create,
+                not self.async_cache)
+        if self.async_cache:
+            cache = yield self._queue_caches(written, updated, wait_cache)
+        else:
+            cache = dict(success=True, affected=cache_affected)
+        defer.returnValue(dict(success=True, affected=affected, cache=cache))
 
     @defer.inlineCallbacks
-    def _do_create(self, c, node_id, relation):
+    def _do_create(self, c, node_id, relation, build=True):
         s = (self.SQL_CREATE_NODE_WITH_ID,
              self.SQL_CREATE_NODE)[node_id is None]
         c = yield c.execute(s, relation)
@@ -331,11 +574,13 @@ WHERE %(where_clause)s"
             result = yield c.execute(self.SQL_GET_LAST_ID)
             id = result.fetchall()
             node_id = id[0][0]
-        cache = yield self._build_cache(c, node_id)
+        cache = None
+        if build:
+            cache = yield self._build_cache(c, node_id)
         defer.returnValue((affected, cache, node_id))
 
     @defer.inlineCallbacks
-    def create(self, node_id, manifest, value):
+    def create(self, node_id, manifest, value, wait_cache=False):
 
         if manifest not in self.manifest:
             raise backend.ManifestNotFound(
@@ -353,27 +598,29 @@ WHERE %(where_clause)s"
                                             create=True)
         relation["value"] = self._serialize_hstore(relation["value"])
         (affected, cache, node_id) = \
-			yield self.pool.runInteraction(self._do_create,
-                                           node_id, relation)
+			yield self._run_node_write(filter(None, [node_id]),
+                                           self._do_create,
+                                           node_id, relation,
+                                           not self.async_cache)
+        if self.async_cache:
+            cache = yield self._queue_caches([node_id], [], wait_cache)
         defer.returnValue(dict(success=True, affected=affected, cache=cache,
 		                       node_id=node_id))
 
     @defer.inlineCallbacks
-    def _do_update(self, c, manifest, node_id, relation):
+    def _do_update(self, c, manifest, node_id, relation, build=True):
         c = yield c.execute(self.SQL_UPDATE_NODE, relation)
         affected = c._cursor.rowcount
+        if not build:
+            defer.returnValue((affected, None))
         cache = yield self._build_cache(c, node_id)
         if cache["success"] == True:
-            depends = yield self._select_depends(c, node_id)
-            for depend in depends:
-                cache = yield self._build_cache(c, depend)
-                if cache["success"]:
-                    affected = affected + 1
-            cache = dict(success=True, affacted=affected)
+            rebuilt = yield self._rebuild_dependents(c, [node_id])
+            cache = dict(success=True, affected=cache["affected"] + rebuilt)
         defer.returnValue((affected, cache))
 
     @defer.inlineCallbacks
-    def update(self, node_id, manifest, value):
+    def update(self, node_id, manifest, value, wait_cache=False):
 
         if manifest not in self.manifest:
             raise backend.ManifestNotFound(
@@ -391,20 +638,25 @@ WHERE %(where_clause)s"
         verified = yield DeferredList(defers, consumeErrors=True)
         relation = yield self._map_relation(node_id, manifest, verified)
         relation["value"] = self._serialize_hstore(relation["value"])
-        (affected, cache) = yield self.pool.runInteraction(self._do_update,
-                                                           manifest,
-                                                           node_id,
-                                                           relation)
+        (affected, cache) = yield self._run_node_write([node_id],
+                                                  self._do_update,
+                                                  manifest,
+                                                  node_id,
+                                                  relation,
+                                                  not self.async_cache)
+        if self.async_cache:
+            cache = yield self._queue_caches([node_id], [node_id],
+                                             wait_cache)
         defer.returnValue(dict(success=True, affected=affected, cache=cache))
 
     @defer.inlineCallbacks
-    def select(self, node_id, cascade):
+    def select(self, node_id, cascade, guard=None):
         if not node_id:
             raise ValueError("id is empty")
 
         if cascade:
-            node = yield self.pool.runInteraction(self._build_node_tree,
-                                                  node_id)
+            node = yield self._run_guarded(guard, self._build_node_tree,
+                                           node_id)
             defer.returnValue(node)
 
         result = yield self.pool.runQuery(self.SQL_SELECT_NODE,
@@ -420,7 +672,7 @@ WHERE %(where_clause)s"
         defer.returnValue(retval)
 
     @defer.inlineCallbacks
-    def _do_delete(self, c, node_id, cascade=None):
+    def _do_delete(self, c, node_id, cascade=None, deleted=None):
 
         referers = yield self._select_referers(c, node_id)
         referers = map(lambda x: int(x[0]), referers)
@@ -430,7 +682,11 @@ WHERE %(where_clause)s"
         node_ids = [node_id]
         if cascade and referers:
             node_ids.extend(referers)
+            if deleted is not None:
+                self.referenced.writing(referers)
+                deleted.extend(referers)
         c = yield c.execute(self.SQL_DELETE_CACHE, dict(id=node_ids))
+        self._bump(c, set(map(lambda x: x[0], c.fetchall())))
         c = yield c.execute(self.SQL_DELETE_NODE, dict(id=node_ids))
         defer.returnValue(c._cursor.rowcount)
 
@@ -440,8 +696,9 @@ WHERE %(where_clause)s"
             raise ValueError("id is empty")
         assert(isinstance(node_id, int))
         # XXX: Cascade DELETE
-        affected = yield self.pool.runInteraction(self._do_delete, node_id,
-                                                  cascade)
+        deleted = [node_id]
+        affected = yield self._run_node_write(deleted, self._do_delete,
+                                              node_id, cascade, deleted)
         defer.returnValue(dict(success=True, affected=affected))
 
     @defer.inlineCallbacks
@@ -464,18 +721,25 @@ WHERE %(where_clause)s"
         defer.returnValue(referers)
 
     @defer.inlineCallbacks
-    def _select_depends(self, c, node_id):
-        c  = yield c.execute(self.SQL_SELECT_NODE_BASIC, dict(id=node_id))
-        nodes = c.fetchall()
-
-        if not nodes:
-            defer.returnValue([])
+    def _select_dependents(self, c, node_ids):
+        c = yield c.execute(self.SQL_SELECT_DEPENDENTS,
+                            dict(id=map(int, node_ids)))
+        defer.returnValue(sorted(set(map(lambda x: int(x[0]),
+                                         c.fetchall()))))
 
-        node_id, manifest, cn, depends = nodes[0]
-        if depends:
-            defer.returnValue(depends)
-        else:
-            defer.returnValue([])
+    @defer.inlineCallbacks
+    def _rebuild_dependents(self, c, node_ids):
+        """
+        Rebuild the caches embedding any of node_ids, once each. depends
+        holds every node on the reference paths a cache was expanded
+        through, the last one included (see _lookup), so this one lookup
+        covers the transitive dependents.
+        """
+        dependents = yield self._select_dependents(c, node_ids)
+        debug("rebuilding %d dependent caches of %d nodes"
+              % (len(dependents), len(node_ids)))
+        affected = yield self._rebuild_batch(c, dependents)
+        defer.returnValue(sum(affected))
 
     @defer.inlineCallbacks
     def _build_node_tree(self, c, node_id, node_cache=None):
@@ -483,62 +747,121 @@ WHERE %(where_clause)s"
         if not node_id:
             raise ValueError("id is empty")
 
-        if node_cache and node_id in node_cache:
-            result = node_cache[node_id]
-        else:
-            c = yield c.execute(self.SQL_SELECT_NODE, dict(id=node_id))
-            result = c.fetchall()
-            if node_cache:
-                node_cache[node_id] = result
-
-        if not result:
-            defer.returnValue(dict())
-
-        raw = dict(map(lambda x: (x[0].decode("UTF-8"),
-                                  x[1].decode("UTF-8")), result))
+        # raw nodes come from node_cache, the memo of the batch, from the
+        # nodes referenced by earlier trees, or from the database
+        node_id = int(node_id)
+        memo = node_cache if node_cache is not None else dict()
+        snapshot = self.referenced.begin()
+        fetched, tried = dict(), set()
+
+        def lookup(x):
+            node = memo.get(x) or fetched.get(x)
+            return node if node is not None else self.referenced.get(x)
+
+        while True:
+            missing = set()
+            node = self._assemble_node(node_id, lookup, missing)
+            missing -= tried
+            if not missing:
+                break
+            # the query does not follow nodes known already. Should one of
+            # the nodes they refer to be gone from the caches since, it is
+            # missing in the next round and fetched then
+            known = list(itertools.islice(itertools.ifilter(
+                lambda x: x not in missing, itertools.chain(
+                    self.referenced.recent(self.MAX_KNOWN_NODES), memo,
+                    fetched)), self.MAX_KNOWN_NODES))
+            c = yield c.execute(self.SQL_SELECT_NODE_TREE,
+                                dict(id=list(missing),
+                                     references=self.references,
+                                     known=known))
+            for row in c.fetchall():
+                if int(row[0]) not in fetched:
+                    fetched[int(row[0])] = self._raw_node(row)
+            tried |= missing
+
+        memo.update(fetched)
+        fetched.pop(node_id, None)
+        self.referenced.put(snapshot, fetched)
+        defer.returnValue(node)
 
-        node = {".id": raw.pop(".id"), ".manifest": raw.pop(".manifest")}
-        node.update(raw)
+    @staticmethod
+    def _raw_node(row):
+        decode = lambda x: x if x is None else x.decode("UTF-8")
+        node_id, manifest, cn, keys, values = row
+        node = dict(izip(map(decode, keys), map(decode, values)))
+        node[".id"], node[".manifest"], node[".cn"] = \
+            unicode(node_id), decode(manifest), decode(cn)
+        return node
+
+    def _assemble_node(self, node_id, lookup, missing):
+        raw = lookup(node_id)
+        if raw is None:
+            missing.add(node_id)
+            return dict()
+
+        node = dict(raw)
         references = filter(lambda x: "reference" in self.field[x],
                             self.manifest[node[".manifest"]]["field"])
         for reference in references:
-            if not node[reference]:
+            if not node.get(reference):
                 continue
-            if not node[reference].startswith("@"):
+            if not node[reference].startswith("@") or \
+                    not node[reference][1:].isdigit():
                 raise backend.DataIntegrityError(id=node_id, field=reference)
-            refer_id = node[reference][1:]
-            refer = yield self._build_node_tree(c, refer_id, node_cache)
-            node.update({reference: refer})
+            node[reference] = self._assemble_node(int(node[reference][1:]),
+                                                  lookup, missing)
+        return node
 
-        defer.returnValue(node)
-
-    def _expand_var(self, v, node, depends):
-        value = ""
-        v = v.group(1).split(".")
-        if v[0] in node:
-            value = node
-            v.reverse()
-            while v and isinstance(value, dict):
-                current_node_id = value[".id"]
-                next_v = v.pop()
-                if next_v in value:
-                    value = value.get(next_v)
-                else:
-                    cache_manifest = self.cache[value[".manifest"]]
-                    if not next_v in cache_manifest:
-                        break
-                    _expand_var = lambda x: self._expand_var(x, value, depends)
-                    value = self.RE_EXPAND_VAR.sub(_expand_var,
-                                                   cache_manifest[next_v])
-                    del v[:]
-                    break
-            depends.add(int(current_node_id))
-            if v:
+    @classmethod
+    def _compile_template(cls, template):
+        """
+        Split a cache template into its literal text and its %{a.b.c}
+        references, the latter as tuples of path names.
+        """
+        plan, last = list(), 0
+        for m in cls.RE_EXPAND_VAR.finditer(template):
+            if m.start() > last:
+                plan.append(template[last:m.start()])
+            plan.append(tuple(m.group(1).split(".")))
+            last = m.end()
+        if last < len(template):
+            plan.append(template[last:])
+        return tuple(plan)
+
+    def _expand(self, plan, node, depends):
+        return "".join([x if x.__class__ is not tuple
+                        else self._lookup(x, node, depends) or ""
+                        for x in plan])
+
+    def _lookup(self, path, node, depends):
+        if path[0] not in node:
+            warn("`%s' not exists in node `%s'" % (list(path), repr(node)))
+            return ""
+        value, i, n = node[path[0]], 1, len(path)
+        if value.__class__ is not dict:
+            if n > 1:
                 warn("parsing error for node %s" % node[".id"])
-            if isinstance(value, dict) and ".cn" in value:
-                value = value[".cn"]
-        else:
-            warn("`%s' not exists in node `%s'" % (v, repr(node)))
+            return value
+        # every referenced node on the path, not only the last one: a
+        # changed reference of a node in between changes the value too
+        depends.add(int(value[".id"]))
+        while i < n and isinstance(value, dict):
+            name, i = path[i], i + 1
+            if name in value:
+                value = value[name]
+                if isinstance(value, dict):
+                    depends.add(int(value[".id"]))
+            else:
+                # not a field, maybe a cache template of the referenced node
+                plans = self.cache_plans[value[".manifest"]]
+                if name in plans:
+                    value, i = self._expand(plans[name], value, depends), n
+                break
+        if i < n:
+            warn("parsing error for node %s" % node[".id"])
+        if isinstance(value, dict) and ".cn" in value:
+            value = value[".cn"]
         return value
 
     @defer.inlineCallbacks
@@ -548,56 +871,212 @@ WHERE %(where_clause)s"
 
         if not node:
             defer.returnValue(dict(success=True, affected=0))
-        cache_manifest = self.cache[node[".manifest"]]
         cache, depends = dict(), set()
-        _expand_var = lambda x: self._expand_var(x, node, depends)
-        for name, value in cache_manifest.items():
-            cache[name] = self.RE_EXPAND_VAR.sub(_expand_var, value)
-        if node_id in depends:
-            depends.remove(node_id)
+        for name, plan in self.cache_plans[node[".manifest"]].items():
+            cache[name] = self._expand(plan, node, depends)
+        depends.discard(int(node_id))
         relation = {"id": node[".id"],
                     "manifest": node[".manifest"],
                     "cn": node[".cn"],
-                    "depends": list(depends)}
+                    "depends": sorted(depends)}
         relation["value"] = self._serialize_hstore(cache)
-        c = yield c.execute(self.SQL_DELETE_CACHE, dict(id=[node_id]))
-        c = yield c.execute(self.SQL_CREATE_CACHE, relation)
-        affected = yield c._cursor.rowcount
+        c = yield c.execute(self.SQL_UPDATE_CACHE_CHANGED, relation)
+        affected, exists = c.fetchall()[0]
+        if not exists:
+            c = yield c.execute(self.SQL_CREATE_CACHE, relation)
+            affected = c._cursor.rowcount
+        # an unchanged cache is left alone, and so are the search results
+        if affected:
+            self._bump(c, [node[".manifest"]])
         defer.returnValue(dict(success=True, affected=affected))
 
     def build_cache(self, node_id):
         assert(isinstance(node_id, int))
-        return self.pool.runInteraction(self._build_cache, node_id)
+        return self._run_write(self._build_cache, node_id)
+
+    @defer.inlineCallbacks
+    def _rebuild_batch(self, c, node_ids):
+        # the number of caches written per node, 0 when left unchanged
+        affected, node_cache = list(), dict()
+        for node_id in node_ids:
+            cache = yield self._build_cache(c, node_id, node_cache)
+            affected.append(cache["affected"] if cache["success"] else 0)
+        defer.returnValue(affected)
 
     @defer.inlineCallbacks
-    def _select_cache(self, c, node_id):
-        c = yield c.execute(self.SQL_SELECT_CACHE, dict(id=node_id))
+    def _rebuild_queued(self, c, node_ids, updated):
+        affected = yield self._rebuild_batch(c, node_ids)
+        dependents = list()
+        if updated:
+            # the caches of this batch are built from committed nodes
+            # already, whatever they depend on
+            dependents = yield self._select_dependents(c, updated)
+            dependents = sorted(set(dependents) - set(node_ids))
+        defer.returnValue((affected, dependents))
+
+    def _queue_caches(self, node_ids, updated, wait_cache):
+        """
+        Queue rebuilding the caches of written nodes. Unless wait_cache,
+        return right away; failures are logged by the queue then.
+        """
+        d = self.rebuild_queue.enqueue(node_ids, updated)
+        if not wait_cache:
+            d.addErrback(lambda x: None)
+            return defer.succeed(dict(success=True, queued=len(node_ids)))
+        d.addCallbacks(lambda x: dict(success=True, affected=x),
+                       lambda x: dict(success=False,
+                                      message=x.getErrorMessage()))
+        return d
+
+    @defer.inlineCallbacks
+    def rebuild_caches(self, manifest=None, q=None, workers=None,
+                       batch_size=None):
+        """
+        Start rebuilding the caches of the nodes of the given manifests,
+        of the cached nodes matching q, or of all nodes, and return the
+        status of the job right away; follow it with rebuild_status().
+        """
+        if q:
+            plan = self.compile_query(q)
+            s = self.SQL_SELECT_CACHE_IDS % dict(
+                where_clause=plan.where_clause)
+            rows = yield self.pool.runQuery(s, plan.params)
+        elif manifest:
+            for name in manifest:
+                if name not in self.manifest:
+                    raise backend.ManifestNotFound(
+                        "manifest '%s' is not found" % name)
+            rows = yield self.pool.runQuery(
+                self.SQL_SELECT_NODE_IDS_BY_MANIFEST, dict(manifest=manifest))
+        else:
+            rows = yield self.pool.runQuery(self.SQL_SELECT_NODE_IDS)
+
+        job_id = next(self.rebuild_ids)
+        job = CacheRebuild(job_id,
+                           lambda x: self._run_write(
+                               self._rebuild_batch, x).addCallback(sum),
+                           map(lambda x: int(x[0]), rows),
+                           workers or self.rebuild_workers,
+                           batch_size or self.rebuild_batch_size,
+                           description=(q and "q=%s" % q or manifest and
+                                        "manifest=%s" % ",".join(manifest)
+                                        or "all"))
+        # keep the running jobs and the last finished ones
+        finished = sorted(filter(
+            lambda x: x.state not in ("pending", "running"),
+            self.rebuilds.values()), key=lambda x: x.job_id)
+        for old in finished[:-self.MAX_REBUILDS]:
+            del self.rebuilds[old.job_id]
+        self.rebuilds[job_id] = job
+        job.start()
+        defer.returnValue(job.status())
+
+    def _rebuild_job(self, job_id):
+        job = self.rebuilds.get(job_id)
+        if job is None:
+            raise backend.JobNotFound("rebuild job %s is not found" % job_id)
+        return job
+
+    def rebuild_status(self, job_id=None):
+        """Progress of a rebuild job, or of all the recent ones."""
+        if job_id is None:
+            return map(lambda x: x.status(), sorted(
+                self.rebuilds.values(), key=lambda x: x.job_id))
+        return self._rebuild_job(job_id).status()
+
+    def stop_rebuild(self, job_id):
+        job = self._rebuild_job(job_id)
+        job.stop()
+        return job.status()
+
+    @defer.inlineCallbacks
+    def _select_cache(self, c, node_id, fields=None):
+        if fields:
+            s, args = self.SQL_SELECT_CACHE_FIELDS, dict(id=node_id,
+                                                         fields=fields)
+        else:
+            s, args = self.SQL_SELECT_CACHE, dict(id=node_id)
+        c = yield c.execute(s, args)
         rows = c.fetchall()
 
         # rebuild cache if node is not found first time
-        if not rows:
+        rebuilt = not rows
+        if rebuilt:
             yield self._build_cache(c, node_id)
-            c = yield c.execute(self.SQL_SELECT_CACHE, dict(id=node_id))
+            c = yield c.execute(s, args)
             rows = c.fetchall()
 
-        defer.returnValue(rows)
+        defer.returnValue((rows, rebuilt))
 
     @defer.inlineCallbacks
-    def select_cache(self, node_id):
+    def select_cache(self, node_id, fields=None):
         if not node_id:
             raise ValueError("id is empty")
 
-        result = yield self.pool.runInteraction(self._select_cache, node_id)
+        result, rebuilt = yield self.pool.runInteraction(self._select_cache,
+                                                         node_id, fields)
         raw = dict(map(lambda x: (x[0].decode("UTF-8"),
                                   x[1].decode("UTF-8")), result))
         retval = {".id": raw.pop(".id"), ".manifest": raw.pop(".manifest")}
         retval.update(raw)
 
+        # searches may have cached the node's absence while it was built
+        if rebuilt:
+            self.results.bump([retval[".manifest"]])
+
         defer.returnValue(retval)
 
     @staticmethod
     def _quote(s):
-        return s.replace("'", "\\'").replace('"', '\\"')
+        return s.replace("\\", "\\\\").replace("'", "\\'") \
+            .replace('"', '\\"')
+
+    @staticmethod
+    def _quote_name(s):
+        # names are embedded in statement templates, which are run with
+        # psycopg placeholders, so literal percent signs are doubled
+        return PostgresBackend._quote(s).replace("%", "%%")
+
+    @staticmethod
+    def _escape_like(s):
+        return s.replace("\\", "\\\\").replace("%", "\\%") \
+            .replace("_", "\\_")
+
+    @staticmethod
+    def _typed_value(field_type, value, pos):
+        try:
+            if field_type == "int":
+                int(value)
+            elif field_type == "decimal":
+                Decimal(value)
+            elif field_type == "date":
+                time.strptime(value, "%Y-%m-%d")
+            elif field_type == "inet":
+                address, _, prefix = value.partition("/")
+                if prefix:
+                    int(prefix)
+                family = (socket.AF_INET, socket.AF_INET6)[":" in address]
+                socket.inet_pton(family, address)
+        except (ValueError, InvalidOperation, socket.error):
+            raise backend.SearchGrammarError(
+                "'%s' is not a valid %s at position %s"
+                % (value, field_type, pos))
+        return value
+
+    @staticmethod
+    def _lower(s):
+        if isinstance(s, str):
+            s = s.decode("UTF-8")
+        return s.lower()
+
+    def _match_manifests(self, term, value):
+        if term == "===":
+            return set(filter(lambda x: x.encode("UTF-8") == value,
+                              self.manifest))
+        elif term in ("==", "IN"):
+            values = set(map(self._lower, value.split(",")))
+            return set(filter(lambda x: x.lower() in values, self.manifest))
+        return None
 
     def _build_where_clause(self, suffix):
         # NOTICE: DO NOT ADD DEFAULT SEARCH HERE
@@ -605,6 +1084,10 @@ WHERE %(where_clause)s"
         #         someone may ask to search it as nodename. PLEASE DO NOT
         #         ADD this feature here in order to keep the code clean !!!
 
+        # Field names are part of the statement text while every value
+        # goes into the parameter list, so searches of the same shape
+        # produce the same template and can share one prepared plan.
+
         suffix.reverse()
         stack = list()
 
@@ -614,177 +1097,670 @@ WHERE %(where_clause)s"
         while suffix:
             term, term_type, pos = suffix.pop()
             if term_type == slex.TOKEN_OPER:
-                rhs, quoted = stack.pop()
-                if not quoted:
-                    rhs = self._quote(rhs)
+                rhs, rparams, _, _, _ = stack.pop()
                 try:
-                    lhs, quoted = stack.pop()
-                    if not quoted:
-                        lhs = self._quote(lhs)
+                    lhs, lparams, _, _, _ = stack.pop()
                 except IndexError:
                     vicinity = " ".join(map(lambda x: x[1], suffix))
                     raise backend.SearchGrammarError(
                         "missing operand near '%s' at position %s"
                         % (vicinity, pos))
-
-                # use ILIKE instead of ~ for case-insensitive
+                if lparams is not None or rparams is not None:
+                    raise backend.SearchGrammarError(
+                        "operand of '%s' is not a value at position %s"
+                        % (term, pos))
+                predicates = ((lhs.lower() if lhs.lower() in
+                               ("manifest", "cn", "id") else lhs, term), )
+                lhs = self._quote_name(lhs)
+
+                # use ILIKE instead of ~ for case-insensitive, it is
+                # served by the trigram index of searchable fields
                 if term in ("~", "!~"):
                     term = ("ILIKE", "NOT ILIKE")[term == "!~"]
-                    # escape special characters of LIKE expression
-                    rhs.replace("%", "\%").replace("_", "\_")
-                    rhs = "%%%s%%" % rhs
+                    rhs = "%%%s%%" % self._escape_like(rhs)
 
+                params, manifests, pairs = [rhs], None, None
+                if lhs.lower() == 'manifest':
+                    manifests = self._match_manifests(term, rhs)
                 if lhs.lower() in ('manifest', 'cn'):
                     if term == '==':
                         where_clause = \
-                            "lower(\"%s\") = lower(E'%s')" % (lhs, rhs)
+                            "lower(\"%s\") = lower(%%s)" % lhs
                     elif term == '!=':
                         where_clause = \
-                            "lower(\"%s\") != lower(E'%s')" % (lhs, rhs)
+                            "lower(\"%s\") != lower(%%s)" % lhs
                     elif term == '===':
-                        where_clause = "\"%s\" = E'%s'" % (lhs, rhs)
+                        where_clause = "\"%s\" = %%s" % lhs
                     elif term == '!==':
-                        where_clause = "\"%s\" != E'%s'" % (lhs, rhs)
+                        where_clause = "\"%s\" != %%s" % lhs
                     elif term == "IN":
-                        _ = ",".join(map(lambda x:
-                                         "lower('%s')" % self._quote(x),
-                                         rhs.split(",")))
-                        where_clause = "lower(%s) = ANY(ARRAY[%s])" % (lhs, _)
+                        params = [map(self._lower, rhs.split(","))]
+                        where_clause = "lower(%s) = ANY(%%s)" % lhs
                     elif term == "^":
-                        where_clause = "lower(\"%s\") LIKE lower(E'%s%%')" % (lhs, rhs)
+                        params = ["%s%%" % self._escape_like(rhs)]
+                        where_clause = "lower(\"%s\") LIKE lower(%%s)" % lhs
                     else:
-                        where_clause = "\"%s\" %s E'%s'" % (lhs, term, rhs)
-                elif lhs.lower() in ('id'):
+                        where_clause = "\"%s\" %s %%s" % (lhs, term)
+                elif lhs.lower() == 'id':
                     if term in ('==', '==='):
-                        term = '='
-                        where_clause = "\"%s\" %s E'%s'" % (lhs, term, rhs)
-                    elif term in ('!=='):
-                        term = '!='
-                        where_clause = "\"%s\" %s E'%s'" % (lhs, term, rhs)
+                        where_clause = "id = %s::bigint"
+                    elif term in ('!=', '!=='):
+                        where_clause = "id != %s::bigint"
                     elif term == "IN":
-                        _ = ",".join(map(lambda x: "%s" % self._quote(x),
-                        rhs.split(",")))
-                        where_clause = "%s = ANY(ARRAY[%s])" % (lhs, _)
+                        params = [rhs.split(",")]
+                        where_clause = "id = ANY(%s::bigint[])"
+                    else:
+                        # ~ was made ILIKE above, report what was written
+                        raise backend.SearchGrammarError(
+                            "operator '%s' is not supported on id at "
+                            "position %s" % (predicates[0][1], pos))
                 elif term == "IN":
-                    _ = ",".join(map(lambda x: "lower('%s')" % self._quote(x),
-                                     rhs.split(",")))
-                    where_clause = \
-                        "lower(value->E'%s') = ANY(ARRAY[%s])" % (lhs, _)
+                    params = [map(self._lower, rhs.split(","))]
+                    where_clause = "lower(value->E'%s') = ANY(%%s)" % lhs
                 elif term == "==":
                     where_clause = \
-                        "lower(value->E'%s') = lower(E'%s')" % (lhs, rhs)
+                        "lower(value->E'%s') = lower(%%s)" % lhs
                 elif term == "!=":
                     where_clause = \
-                        "lower(value->E'%s') != lower(E'%s')" % (lhs, rhs)
+                        "lower(value->E'%s') != lower(%%s)" % lhs
                 elif term == "===":
-                    where_clause = "value->E'%s' = E'%s'" % (lhs, rhs)
+                    pairs = [(lhs, rhs)]
+                    where_clause, params = self._conjunction(pairs, [])
                 elif term == "!==":
-                    where_clause = "value->E'%s' != E'%s'" % (lhs, rhs)
-                elif term in ("^"):
+                    where_clause = "value->E'%s' != %%s" % lhs
+                elif term in ("<", "<=", ">", ">=") and lhs in self.types:
+                    field_type = self.types[lhs]
+                    params = [self._typed_value(field_type, rhs, pos)]
+                    where_clause = "sitebase_to_%s(value->E'%s') %s %%s::%s" \
+                        % (field_type, lhs, term, self.FIELD_TYPES[field_type])
+                elif term == "^" and lhs in self.searchable:
+                    params = ["%s%%" % self._escape_like(rhs)]
+                    where_clause = "value->E'%s' ILIKE %%s" % lhs
+                elif term == "^":
                     term = "LIKE"
-                    rhs.replace("%", "\%").replace("_", "\_")
-                    rhs = "%s%%" % rhs
-                    where_clause = "lower(value->E'%s') LIKE lower(E'%s')" \
-                        % (lhs, rhs)
+                    params = ["%s%%" % self._escape_like(rhs)]
+                    where_clause = "lower(value->E'%s') LIKE lower(%%s)" % lhs
                 else:
-                    where_clause = "value->E'%s' %s E'%s'" % (lhs, term, rhs)
+                    where_clause = "value->E'%s' %s %%s" % (lhs, term)
 
-                stack.append((where_clause, True))
+                if pairs:
+                    conjunction = (pairs, [])
+                else:
+                    conjunction = ([], [(where_clause, params)])
+                stack.append((where_clause, params, manifests, predicates,
+                              conjunction))
             elif term_type == slex.TOKEN_LOGIC:
                 try:
-                    rhs, quoted = stack.pop()
-                    lhs, quoted = stack.pop()
+                    rhs, rparams, rmanifests, rpredicates, rconjunction = \
+                        stack.pop()
+                    lhs, lparams, lmanifests, lpredicates, lconjunction = \
+                        stack.pop()
                 except IndexError:
                     vicinity = term
                     raise backend.SearchGrammarError(
                         "missing logic clause near '%s' at position %s"
                         % (vicinity, pos))
-                where_clause = " ".join((lhs, term.upper(), rhs))
-                stack.append(("(%s)" % where_clause, True))
+                if lparams is None or rparams is None:
+                    raise backend.SearchGrammarError(
+                        "operand of '%s' is not a clause at position %s"
+                        % (term, pos))
+                # manifests the clause can match, None for any of them
+                if term.upper() == "OR":
+                    manifests = (None if lmanifests is None or
+                                 rmanifests is None else
+                                 lmanifests | rmanifests)
+                elif lmanifests is None or rmanifests is None:
+                    manifests = rmanifests if lmanifests is None \
+                        else lmanifests
+                else:
+                    manifests = lmanifests & rmanifests
+                if term.upper() == "AND":
+                    # exact matches are gathered into a single containment
+                    pairs, others = list(lconjunction[0]), \
+                        lconjunction[1] + rconjunction[1]
+                    for pair in rconjunction[0]:
+                        if pair[0] in map(lambda x: x[0], pairs):
+                            others.append(self._conjunction([pair], []))
+                        else:
+                            pairs.append(pair)
+                    where_clause, params = self._conjunction(pairs, others)
+                    conjunction = (pairs, others)
+                else:
+                    where_clause = "(%s OR %s)" % (lhs, rhs)
+                    params = lparams + rparams
+                    conjunction = ([], [(where_clause, params)])
+                stack.append((where_clause, params, manifests,
+                              lpredicates + rpredicates, conjunction))
             else:
-                stack.append((term, False))
+                stack.append((term, None, None, None, None))
 
-        if len(stack) == 1:
-            return stack[0][0]
+        if len(stack) == 1 and stack[0][1] is not None:
+            return SearchPlan(where_clause=stack[0][0], params=stack[0][1],
+                              manifests=stack[0][2], predicates=stack[0][3])
         else:
             raise backend.SearchGrammarError(
                 "syntax error at position %s" % (pos))
 
+    @staticmethod
+    def _conjunction(pairs, others):
+        """
+        AND together exact matches, given as (field, value) pairs, and
+        other clauses, given as (clause, params). All the pairs go into
+        one hstore containment, which the GIN index on value serves.
+        """
+        clauses, params = list(), list()
+        if pairs:
+            clauses.append("value @> hstore(ARRAY[%s], ARRAY[%s])" % (
+                ", ".join(map(lambda x: "E'%s'" % x[0], pairs)),
+                ", ".join(["%s"] * len(pairs))))
+            params.extend(map(lambda x: x[1], pairs))
+        for clause, clause_params in others:
+            clauses.append(clause)
+            params.extend(clause_params)
+        if len(clauses) == 1:
+            return clauses[0], params
+        return "(%s)" % " AND ".join(clauses), params
+
+    def compile_query(self, q):
+        """
+        Compile a search query into its SearchPlan. Compiled plans are
+        kept in a bounded LRU keyed by the normalized query text, so a
+        query is lexed and parsed only once however often it is searched.
+        """
+        key = slex.normalize(q)
+        plan = self.plans.get(key)
+        if plan is None:
+            plan = self._build_where_clause(slex.parse(q))
+            self.plans.set(key, plan)
+        return plan
+
+    @staticmethod
+    def _param_type(param):
+        if isinstance(param, list):
+            return "text[]"
+        elif isinstance(param, (int, long)):
+            return "bigint"
+        return "text"
+
     @defer.inlineCallbacks
-    def _search(self, c, where_clause, start, num,
-                order_by, order, return_total):
+    def _execute(self, c, sql, params):
+        """
+        Run a statement written with psycopg placeholders as a named
+        prepared statement of the current connection. Statements of the
+        same shape are planned once per connection whatever the values.
+        """
+        if not self.prepare:
+            c = yield c.execute(sql, params)
+            defer.returnValue(c)
+
+        prepared = self.prepared.setdefault(c._cursor.connection, set())
+        name = "sitebase_%s" % hashlib.md5(sql).hexdigest()
+        if name not in prepared:
+            if len(prepared) >= self.max_prepared:
+                c = yield c.execute("DEALLOCATE ALL")
+                prepared.clear()
+            counter = itertools.count(1)
+            body = self.RE_PLACEHOLDER.sub(
+                lambda m: ("%", "$%d" % next(counter))[m.group(1) == "s"],
+                sql)
+            if params:
+                types = ", ".join(map(self._param_type, params))
+                s = "PREPARE %s (%s) AS %s" % (name, types, body)
+            else:
+                s = "PREPARE %s AS %s" % (name, body)
+            debug("prepare %s: %s" % (name, body))
+            c = yield c.execute(s)
+            prepared.add(name)
 
-        def _reduce(result, row):
-            if not isinstance(result, list):
-                id, key, value = result
-                result = [{".id": id, key: value}]
+        if params:
+            s = "EXECUTE %s (%s)" % (name, ", ".join(["%s"] * len(params)))
+            c = yield c.execute(s, params)
+        else:
+            c = yield c.execute("EXECUTE %s" % name)
+        defer.returnValue(c)
 
-            id, key, value = row
-            last_id = result[-1][".id"]
+    def stats(self):
+        return dict(plan_cache=self.plans.stats(),
+                    result_cache=self.results.stats(),
+                    reference_cache=self.referenced.stats(),
+                    cache_queue=self.rebuild_queue.stats())
 
-            if last_id == id:
-                result[-1][key] = value
-            else:
-                result.append({".id": id, key: value})
+    @defer.inlineCallbacks
+    def advise_indexes(self, min_count=1):
+        """
+        Report the recorded search predicates together with the CREATE
+        statements for the node_cache indexes they miss and the DROP
+        statements for auto indexes neither they nor anything else scans.
+        """
+        rows = yield self.pool.runQuery(self.SQL_SELECT_AUTO_INDEXES)
+        existing = dict(map(lambda x: (x[0], (x[1], x[2])), rows))
+        result = self.advisor.advise(existing, min_count)
+        result["predicates"] = self.advisor.stats()
+        defer.returnValue(result)
+
+    @staticmethod
+    def _encode_cursor(order_by, value, node_id):
+        return base64.urlsafe_b64encode(json_encode([order_by, value,
+                                                     node_id]))
 
-            return result
+    @staticmethod
+    def _decode_cursor(order_by, after):
+        try:
+            cursor_order_by, value, node_id = \
+                json_decode(base64.urlsafe_b64decode(after))
+            node_id = int(node_id)
+        except (TypeError, ValueError):
+            raise backend.InvalidCursor("malformed cursor")
+        if cursor_order_by != order_by:
+            raise backend.InvalidCursor("cursor was issued for order_by=%s"
+                                        % cursor_order_by)
+        return value, node_id
 
-        # count total
-        if return_total:
-            startTime = time.time()
-            s = self.SQL_COUNT_CACHE_EX % dict(where_clause=where_clause)
-            debug('SQL_SELECT_CACHE_EX: %s' % s)
-            c = yield c.execute(s)
-            total = c.fetchall()[0][0]
-            debug("count duration: %.3fms" % \
-                      (1000 * (time.time() - startTime)))
+    @staticmethod
+    def _seek_clause(order_expr, order, value, node_id):
+        """
+        Translate the last (order value, id) of a page into the predicate
+        selecting the rows after it, following ORDER BY ... NULLS FIRST.
+        """
+        cmp = (">", "<")[order == "DESC"]
+        if order_expr == "id":
+            return "id %s %%s" % cmp, [node_id]
+        elif value is None:
+            return ("(%s IS NULL AND id %s %%s OR %s IS NOT NULL)"
+                    % (order_expr, cmp, order_expr)), [node_id]
+        return ("(%s %s %%s OR %s = %%s AND id %s %%s)"
+                % (order_expr, cmp, order_expr, cmp)), [value, value, node_id]
+
+    @staticmethod
+    def _make_node(row):
+        node_id, manifest, cn, keys, values = row[:5]
+        node = dict(izip(keys, values))
+        node[".id"], node[".manifest"], node[".cn"] = node_id, manifest, cn
+        return node
+
+    def _order_expr(self, order_by):
+        if order_by not in ("id", "manifest", "cn"):
+            return "value->E'%s'" % (self._quote_name(order_by))
         else:
-            total = 0
+            return order_by
 
-        # fetch result
-        startTime = time.time()
+    @staticmethod
+    def _projection(fields, column="value"):
+        # the field names are bound, so one statement serves any of them
+        if fields:
+            return "slice(%s, %%s::text[])" % column, [list(fields)]
+        else:
+            return column, []
+
+    def _select_statement(self, plan, start, num, order_by, order, after,
+                          fields=None, total=False):
         order = ("DESC", "ASC")[order.upper() == "ASC"]
-        if order_by not in ("id", "manifest", "cn"):
-            order_by = "value->'%s'" % (self._quote(order_by))
+        order_expr = self._order_expr(order_by)
+        projection, params = self._projection(fields)
+        # the projection is spelled out twice, for the keys and the values
+        where_clause, params = plan.where_clause, params * 2 + plan.params
+        if after:
+            value, node_id = after
+            seek, seek_params = self._seek_clause(order_expr, order,
+                                                  value, node_id)
+            where_clause = "%s AND %s" % (where_clause, seek)
+            params = params + seek_params
         s = self.SQL_SELECT_CACHE_EX % dict(where_clause=where_clause,
-                                            offset=start,
-                                            limit=(num, 'ALL')[num == 0],
-                                            order_by=order_by,
+                                            value=projection,
+                                            total=("NULL",
+                                                   "count(1) OVER ()")[total],
+                                            limit=("%s", "ALL")[num == 0],
+                                            order_by=order_expr,
                                             order=order)
+        # the cursor already skips the rows before it, start does not add
+        params = params + ([num], [])[num == 0] + [(start, 0)[bool(after)]]
+        return s, params
+
+    @defer.inlineCallbacks
+    def _count(self, c, plan):
+        startTime = time.time()
+        s = self.SQL_COUNT_CACHE_EX % dict(where_clause=plan.where_clause)
+        debug('SQL_COUNT_CACHE_EX: %s' % s)
+        c = yield self._execute(c, s, plan.params)
+        total = c.fetchall()[0][0]
+        debug("count duration: %.3fms" % (1000 * (time.time() - startTime)))
+        defer.returnValue(total)
+
+    @defer.inlineCallbacks
+    def _estimate(self, c, plan):
+        s = self.SQL_EXPLAIN_CACHE_EX % dict(where_clause=plan.where_clause)
+        c = yield c.execute(s, plan.params)
+        match = self.RE_PLAN_ROWS.search(c.fetchall()[0][0])
+        defer.returnValue(int(match.group(1)) if match else 0)
+
+    @defer.inlineCallbacks
+    def _search(self, c, plan, start, num,
+                order_by, order, return_total, after=None, fields=None):
+
+        # fetch result, counting the matches in the same statement unless
+        # the seek predicate of a cursor narrows the rows down
+        startTime = time.time()
+        window = return_total == "exact" and not after
+        s, params = self._select_statement(plan, start, num, order_by, order,
+                                           after, fields, window)
         debug('SQL_SELECT_CACHE_EX: %s' % s)
-        c = yield c.execute(s)
+        c = yield self._execute(c, s, params)
         result = c.fetchall()
+        self.advisor.record(plan.predicates, time.time() - startTime)
         debug("fetch duration: %.3fms" % (1000 * (time.time() - startTime)))
 
+        # count total
+        if window and result:
+            total = result[0][6]
+        elif return_total == "exact":
+            total = yield self._count(c, plan)
+        elif return_total == "estimate":
+            total = yield self._estimate(c, plan)
+        else:
+            total = 0
+
         # data processing
-        nodes = defaultdict(dict)
         startTime = time.time()
-        if result:
-            nodes = reduce(_reduce, result)
-        else:
-            nodes = list()
+        nodes = map(self._make_node, result)
 
         debug("value parsing duration: %.3fms" \
                   % (1000 * (time.time() - startTime)))
 
+        # cursor of the next page, in case this one is full; the order
+        # value is selected on its own since fields may not include it
+        if num and len(result) == num:
+            last = result[-1]
+            next_cursor = self._encode_cursor(order_by, last[5], last[0])
+        else:
+            next_cursor = None
+
         defer.returnValue(dict(start=start,
                                num=len(nodes),
                                total=total,
+                               next=next_cursor,
                                result=nodes))
 
+    def _plan_search(self, q, start=0, num=20,
+                     order_by="id", order="asc", return_total=False,
+                     after=None, fields=None):
+        plan = self.compile_query(q)
+        if after:
+            after = self._decode_cursor(order_by, after)
+        return_total = {"1": "exact",
+                        "estimate": "estimate"}.get(return_total)
+        args = (start, num, order_by, order, return_total, after, fields)
+        key = repr((plan.where_clause, plan.params) + args)
+        return plan, args, key
+
     @defer.inlineCallbacks
     def search(self, q, start=0, num=20,
-               order_by="id", order="asc", return_total=False):
-
-        suffix = slex.parse(q)
-        where_clause = self._build_where_clause(suffix)
-        result = yield self.pool.runInteraction(self._search,
-                                                where_clause,
-                                                start, num,
-                                                order_by, order,
-                                                return_total == "1")
+               order_by="id", order="asc", return_total=False, after=None,
+               fields=None, guard=None):
+
+        plan, args, key = self._plan_search(q, start, num, order_by, order,
+                                            return_total, after, fields)
+        result = self.results.get(key, plan.manifests)
+        if result is not None:
+            defer.returnValue(result)
+
+        snapshot = self.results.snapshot(plan.manifests)
+        result = yield self._run_guarded(guard, self._search, plan, *args)
+        self.results.put(key, snapshot, plan.manifests, result)
         defer.returnValue(result)
 
+    @defer.inlineCallbacks
+    def _search_batch(self, c, searches):
+        result = list()
+        for plan, args in searches:
+            r = yield self._search(c, plan, *args)
+            result.append(r)
+        defer.returnValue(result)
+
+    @defer.inlineCallbacks
+    def search_batch(self, queries, guard=None):
+        """
+        Run a list of searches, each a dict of search() arguments, on one
+        connection in a single interaction. Fires with a list in the same
+        order holding either the result or the error of each search.
+        Queries which do not compile fail on their own; an error raised
+        by the database fails the whole batch.
+        """
+        results = [None] * len(queries)
+        pending = list()
+        for i, query in enumerate(queries):
+            try:
+                plan, args, key = self._plan_search(**query)
+            except (slex.ParseError, backend.SearchGrammarError,
+                    backend.InvalidCursor) as e:
+                results[i] = e
+                continue
+            result = self.results.get(key, plan.manifests)
+            if result is not None:
+                results[i] = result
+            else:
+                snapshot = self.results.snapshot(plan.manifests)
+                pending.append((i, plan, args, key, snapshot))
+
+        if pending:
+            found = yield self._run_guarded(
+                guard, self._search_batch,
+                map(lambda x: (x[1], x[2]), pending))
+            for (i, plan, args, key, snapshot), result in izip(pending, found):
+                self.results.put(key, snapshot, plan.manifests, result)
+                results[i] = result
+        defer.returnValue(results)
+
+    @defer.inlineCallbacks
+    def _facets(self, c, plan, facets, top):
+        # the facet names are bound, so one statement serves any of them
+        s = self.SQL_FACET_CACHE_EX % dict(where_clause=plan.where_clause,
+                                           top=("rank <= %s", "true")[not top])
+        params = [facets] + plan.params + ([top], [])[not top]
+        debug('SQL_FACET_CACHE_EX: %s' % s)
+        startTime = time.time()
+        c = yield self._execute(c, s, params)
+        self.advisor.record(plan.predicates, time.time() - startTime)
+
+        result = dict(map(lambda x: (x, list()), facets))
+        for key, value, count in c.fetchall():
+            result[key].append(dict(value=value, count=count))
+        defer.returnValue(result)
+
+    @defer.inlineCallbacks
+    def facets(self, q, facets, top=0, guard=None):
+        """
+        Count the nodes matching q per distinct value of each facet field
+        in one grouped statement, keeping the top values when top is set.
+        """
+        plan = self.compile_query(q)
+        key = repr(("facets", plan.where_clause, plan.params, facets, top))
+        result = self.results.get(key, plan.manifests)
+        if result is None:
+            snapshot = self.results.snapshot(plan.manifests)
+            facets = yield self._run_guarded(guard, self._facets, plan,
+                                             facets, top)
+            result = dict(facets=facets)
+            self.results.put(key, snapshot, plan.manifests, result)
+        defer.returnValue(result)
+
+    def _saved_stamp(self, row):
+        """
+        Return what the materialization of a saved search row depends on,
+        or None while that cannot be told (a write of one of the manifests
+        it can match is in flight).
+        """
+        name, q, order_by, order = row[:4]
+        plan = self.compile_query(q)
+        snapshot = self.results.version(plan.manifests)
+        if snapshot is None:
+            return plan, None
+        return plan, (q, order_by, order, snapshot)
+
+    @defer.inlineCallbacks
+    def _refresh_saved(self, c, name, plan, order_by, order):
+        # serialize refreshes of one search, they rewrite the same rows
+        c = yield c.execute(self.SQL_LOCK_SAVED, dict(name=name))
+        c = yield c.execute(self.SQL_CLEAR_SAVED_RESULT, (name, ))
+        s = self.SQL_FILL_SAVED_RESULT % dict(
+            order_by=self._order_expr(order_by),
+            order=("DESC", "ASC")[order.upper() == "ASC"],
+            where_clause=plan.where_clause)
+        debug('SQL_FILL_SAVED_RESULT: %s' % s)
+        startTime = time.time()
+        c = yield c.execute(s, [name] + plan.params)
+        self.advisor.record(plan.predicates, time.time() - startTime)
+        total = c._cursor.rowcount
+        yield c.execute(self.SQL_UPDATE_SAVED, (total, name))
+        defer.returnValue(total)
+
+    @defer.inlineCallbacks
+    def _select_saved(self, c, name, start, num, fields):
+        c = yield c.execute(self.SQL_SELECT_SAVED, dict(name=name))
+        rows = c.fetchall()
+        if not rows:
+            raise backend.SearchNotFound("no saved search named %s" % name)
+        total = rows[0][4]
+        plan, stamp = self._saved_stamp(rows[0])
+        if stamp is None or self.saved.get(name) != stamp:
+            total = yield self._refresh_saved(c, name, plan, rows[0][2],
+                                              rows[0][3])
+
+        value, params = self._projection(fields, "c.value")
+        s = self.SQL_SELECT_SAVED_RESULT % dict(
+            value=value, limit=("%s", "ALL")[num == 0])
+        c = yield self._execute(c, s, params * 2 + [name] +
+                                ([num], [])[num == 0] + [start])
+        nodes = map(self._make_node, c.fetchall())
+        defer.returnValue((dict(name=name, start=start, num=len(nodes),
+                                total=total, result=nodes), stamp))
+
+    @defer.inlineCallbacks
+    def select_saved(self, name, start=0, num=20, fields=None, guard=None):
+        """
+        Read a page of a saved search from its materialized result. The
+        materialization is evaluated again first when a node of one of
+        the manifests the search can match was written since.
+        """
+        result, stamp = yield self._run_guarded(guard, self._select_saved,
+                                                name, start, num, fields)
+        if stamp is not None:
+            self.saved[name] = stamp
+        defer.returnValue(result)
+
+    @defer.inlineCallbacks
+    def _save_search(self, c, name, q, order_by, order):
+        c = yield c.execute(self.SQL_DELETE_SAVED, dict(name=name))
+        yield c.execute(self.SQL_CREATE_SAVED, dict(name=name, q=q,
+                                                    order_by=order_by,
+                                                    order=order))
+
+    @defer.inlineCallbacks
+    def save_search(self, name, q, order_by="id", order="asc"):
+        # refuse what would not compile before storing it
+        self.compile_query(q)
+        self.saved.pop(name, None)
+        yield self.pool.runInteraction(self._save_search, name, q,
+                                       order_by, order)
+        defer.returnValue(dict(success=True, name=name))
+
+    @defer.inlineCallbacks
+    def delete_saved_search(self, name):
+        self.saved.pop(name, None)
+        result = yield self.pool.runInteraction(
+            lambda c: c.execute(self.SQL_DELETE_SAVED, dict(name=name)))
+        if not result._cursor.rowcount:
+            raise backend.SearchNotFound("no saved search named %s" % name)
+        defer.returnValue(dict(success=True, name=name))
+
+    @defer.inlineCallbacks
+    def saved_searches(self):
+        rows = yield self.pool.runQuery(self.SQL_LIST_SAVED)
+        defer.returnValue(map(lambda x: dict(name=x[0], q=x[1],
+                                             order_by=x[2], order=x[3],
+                                             total=x[4]), rows))
+
+    def _export(self, s, params, target):
+        # COPY is not available on the asynchronous connections of the
+        # pool, so it runs on a connection of its own in a thread
+        connection = psycopg2.connect(*self.connect_args[0],
+                                      **self.connect_args[1])
+        try:
+            cursor = connection.cursor()
+            writer = CopyWriter(target)
+            cursor.copy_expert(cursor.mogrify(s, params), writer)
+            writer.flush()
+            return cursor.rowcount
+        finally:
+            connection.close()
+
+    def export(self, q, target, format="ndjson", fields=None):
+        """
+        Write every node matching q as ndjson or csv, produced by COPY TO
+        STDOUT, to target() chunk by chunk; target() may return a Deferred
+        to hold the export back. Fires with the number of nodes written.
+        At most max_exports run at a time, the others wait their turn.
+        """
+        plan = self.compile_query(q)
+        if format == "csv":
+            if fields:
+                columns = ", ".join(map(
+                    lambda x: "value->%%s AS \"%s\"" % (
+                        x.replace('"', '""').replace("%", "%%")), fields))
+            else:
+                columns = "hstore_to_json(value) AS value"
+            s = self.SQL_EXPORT_CSV % dict(columns=columns,
+                                           where_clause=plan.where_clause)
+            params = list(fields or ()) + plan.params
+        else:
+            value, params = self._projection(fields)
+            s = self.SQL_EXPORT_NDJSON % dict(value=value,
+                                              where_clause=plan.where_clause)
+            params = params * 2 + plan.params
+        debug('SQL_EXPORT: %s' % s)
+        return self.exports.run(threads.deferToThread, self._export, s,
+                                params, target)
+
+    @defer.inlineCallbacks
+    def _search_stream(self, c, plan, start, num, order_by, order, after,
+                       fields, consume, batch):
+        s, params = self._select_statement(plan, start, num,
+                                           order_by, order, after, fields)
+        s = self.SQL_DECLARE_STREAM % dict(query=s)
+        debug('SQL_DECLARE_STREAM: %s' % s)
+        startTime = time.time()
+        c = yield c.execute(s, params)
+        c = yield c.execute(self.SQL_FETCH_STREAM % dict(size=batch))
+        self.advisor.record(plan.predicates, time.time() - startTime)
+
+        total = 0
+        while True:
+            rows = c.fetchall()
+            if not rows:
+                break
+            total += len(rows)
+            # wait until the consumer is ready before fetching more
+            yield consume(map(self._make_node, rows))
+            c = yield c.execute(self.SQL_FETCH_STREAM % dict(size=batch))
+        defer.returnValue(total)
+
+    @defer.inlineCallbacks
+    def search_stream(self, q, consume, start=0, num=0, order_by="id",
+                      order="asc", after=None, fields=None, batch=1000,
+                      guard=None):
+        """
+        Search like search(), but walk the result with a server-side
+        cursor and hand it to consume() one batch of nodes at a time.
+        consume() returns a Deferred which fires when it is ready for the
+        next batch. Fires with the number of nodes streamed.
+        """
+        plan = self.compile_query(q)
+        if after:
+            after = self._decode_cursor(order_by, after)
+        total = yield self._run_guarded(guard, self._search_stream, plan,
+                                        start, num, order_by, order,
+                                        after, fields, consume, batch)
+        defer.returnValue(total)
+
     @defer.inlineCallbacks
     def _compare(self, c, relations, force_create):
 
@@ -814,7 +1790,7 @@ WHERE %(where_clause)s"
         defer.returnValue((modifications, origins))
 
     @defer.inlineCallbacks
-    def compare(self, input, force_create=False):
+    def compare(self, input, force_create=False, guard=None):
 
         relations = list()
         errors = list()
@@ -856,8 +1832,8 @@ WHERE %(where_clause)s"
                 errors.append((node_id, e))
 
         differences, origins = \
-            yield self.pool.runInteraction(self._compare, relations,
-                                           force_create)
+            yield self._run_guarded(guard, self._compare, relations,
+                                    force_create)
         defer.returnValue(dict(success=True,
                                errors=backend.BatchOperationError(errors),
                                origins=origins,
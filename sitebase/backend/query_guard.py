@@ -0,0 +1,76 @@
+from psycopg2.extensions import QueryCanceledError
+from twisted.internet import defer, threads
+
+from sitebase import backend
+from ysl.twisted.log import debug, warn
+
+import threading
+
+__all__ = ["QueryGuard"]
+
+
+class QueryGuard(object):
+    """
+    Deadline and cancellation of the statements of one interaction.
+
+    The interaction runs under a transaction-local statement_timeout, and
+    cancel() asks the server to cancel the statement it is running, e.g.
+    when the client went away: cancelling the Deferred alone leaves the
+    statement running and its pooled connection busy until it is done.
+
+    The cancel request is sent from a thread, which may only get to it
+    once the interaction is over and the connection serves another one,
+    so it is sent under a lock and only while the interaction runs.
+    """
+
+    SQL_SET_TIMEOUT = "SELECT set_config('statement_timeout', %s, true)"
+
+    def __init__(self, timeout=0):
+        self.timeout = timeout
+        self.connection = None
+        self.cancelled = False
+        self.lock = threading.Lock()
+
+    def limit(self, timeout):
+        """Apply a timeout in ms of the request if it is the shorter one."""
+        if timeout > 0 and (not self.timeout or timeout < self.timeout):
+            self.timeout = timeout
+
+    @defer.inlineCallbacks
+    def run(self, c, interaction, *args, **kwargs):
+        if self.cancelled:
+            raise defer.CancelledError("request was cancelled")
+        self.connection = c._cursor.connection
+        try:
+            if self.timeout:
+                yield c.execute(self.SQL_SET_TIMEOUT, (str(self.timeout), ))
+            result = yield interaction(c, *args, **kwargs)
+        except (QueryCanceledError, defer.CancelledError):
+            # txpostgres reports a canceled statement as CancelledError
+            if self.cancelled:
+                raise defer.CancelledError("request was cancelled")
+            elif not self.timeout:
+                raise
+            raise backend.QueryTimeout("statement timed out after %dms"
+                                       % self.timeout)
+        finally:
+            # before runInteraction() commits, the COMMIT is not ours to
+            # cancel
+            with self.lock:
+                self.connection = None
+        defer.returnValue(result)
+
+    def cancel(self):
+        self.cancelled = True
+        if self.connection is None:
+            return
+        debug("cancelling running statement")
+        # PQcancel opens a connection of its own, keep it off the reactor
+        d = threads.deferToThread(self._cancel, self.connection)
+        d.addErrback(lambda x: warn("cancel request failed: %s"
+                                    % x.getErrorMessage()))
+
+    def _cancel(self, connection):
+        with self.lock:
+            if self.connection is connection:
+                connection.cancel()
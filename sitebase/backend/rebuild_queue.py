@@ -0,0 +1,126 @@
+from collections import OrderedDict
+from itertools import izip
+from twisted.internet import defer
+
+from ysl.twisted.log import debug, warn
+
+__all__ = ["RebuildQueue"]
+
+
+class RebuildQueue(object):
+    """
+    De-duplicating queue of node caches to rebuild after their nodes
+    were written.
+
+    An id queued again before it was taken is rebuilt once, for all the
+    writes queueing it; an id queued while it is being rebuilt is queued
+    anew, as the rebuild may have read the node before the write. Up to
+    workers batches of up to batch_size ids are rebuilt at a time by
+    run_batch(ids, updated), which fires with the number of caches
+    written per id and the ids of the caches embedding the updated ones;
+    those are queued in turn, so a rack shared by many written servers
+    is looked up once per batch rather than once per server.
+    """
+
+    def __init__(self, run_batch, workers=2, batch_size=200):
+        self.run_batch = run_batch
+        self.workers = max(1, workers)
+        self.batch_size = max(1, batch_size)
+        # id -> [updated, [_Waiters of the writes waiting for it]]
+        self.pending = OrderedDict()
+        self.running = 0
+        self.in_flight = 0
+        self.done, self.failed, self.affected = 0, 0, 0
+
+    def enqueue(self, node_ids, updated=()):
+        """
+        Queue the caches of node_ids, and of the caches embedding the
+        updated ones. Fires with the number of caches written, dependents
+        included, once all of them are rebuilt; nobody has to wait for it.
+        """
+        waiter = _Waiter(len(node_ids))
+        updated = set(updated)
+        for node_id in node_ids:
+            entry = self.pending.setdefault(node_id, [False, list()])
+            entry[0] = entry[0] or node_id in updated
+            entry[1].append(waiter)
+        self._drain()
+        return waiter.deferred
+
+    def _drain(self):
+        while self.pending and self.running < self.workers:
+            batch = list()
+            while self.pending and len(batch) < self.batch_size:
+                batch.append(self.pending.popitem(last=False))
+            self.running += 1
+            self.in_flight += len(batch)
+            self._run(batch)
+
+    @defer.inlineCallbacks
+    def _run(self, batch):
+        node_ids = map(lambda x: x[0], batch)
+        updated = map(lambda x: x[0], filter(lambda x: x[1][0], batch))
+        try:
+            affected, dependents = yield self.run_batch(node_ids, updated)
+        except Exception as e:
+            warn("queued rebuild of %d caches failed: %s"
+                 % (len(node_ids), str(e)))
+            self.failed += len(node_ids)
+            result = e
+        else:
+            debug("rebuilt %d queued caches, %d dependents to go"
+                  % (len(node_ids), len(dependents)))
+            self.done += len(node_ids)
+            self.affected += sum(affected)
+            result = None
+            for (node_id, (_, waiters)), count in izip(batch, affected):
+                for waiter in waiters:
+                    waiter.affected += count
+        finally:
+            # the worker is free before the dependents are waited for,
+            # they may need it
+            self.running -= 1
+            self.in_flight -= len(node_ids)
+
+        if result is None and dependents:
+            try:
+                count = yield self.enqueue(dependents)
+            except Exception as e:
+                result = e
+            else:
+                # written on behalf of the writes updating nodes of the
+                # batch, once for each of them
+                for waiter in set(sum(map(lambda x: x[1][1], filter(
+                        lambda x: x[1][0], batch)), [])):
+                    waiter.affected += count
+        else:
+            self._drain()
+
+        for node_id, (_, waiters) in batch:
+            for waiter in waiters:
+                waiter.done(result)
+
+    def stats(self):
+        return dict(pending=len(self.pending), in_flight=self.in_flight,
+                    workers=self.workers, done=self.done,
+                    failed=self.failed, affected=self.affected)
+
+
+class _Waiter(object):
+    """A write waiting for its queued caches, counting those written."""
+
+    def __init__(self, count):
+        self.deferred = defer.Deferred()
+        self.left, self.affected = count, 0
+        if not count:
+            self.deferred.callback(0)
+
+    def done(self, error=None):
+        if self.deferred.called:
+            return
+        elif error is not None:
+            self.deferred.errback(error)
+            return
+        self.left -= 1
+        if not self.left:
+            self.deferred.callback(self.affected)
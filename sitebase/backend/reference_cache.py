@@ -0,0 +1,72 @@
+from ysl.util import LRUCache
+
+__all__ = ["ReferenceCache"]
+
+
+class ReferenceCache(object):
+    """
+    In-process cache of the raw nodes read while building node trees,
+    so that the racks, sites and models shared by many nodes are fetched
+    once rather than for every node referring to them.
+
+    Writers announce the nodes they write with writing() before writing
+    them and written() once their transaction is over. A node being
+    written is neither handed out nor stored, and a read which began
+    before a write of a node ended is not stored either, as it may have
+    seen the node before the write.
+    """
+
+    def __init__(self, capacity, max_written=65536):
+        self.nodes = LRUCache(capacity)
+        self.max_written = max_written
+        self.generation = 0
+        self.sequence = 0
+        self.in_flight = dict()
+        self.written_at = dict()
+
+    def begin(self):
+        """Snapshot to hand to put() with the nodes read from now on."""
+        return (self.generation, self.sequence)
+
+    def get(self, node_id):
+        if not self.nodes.capacity or node_id in self.in_flight:
+            return None
+        return self.nodes.get(node_id)
+
+    def recent(self, limit):
+        return self.nodes.keys(limit) if self.nodes.capacity else []
+
+    def put(self, snapshot, nodes):
+        generation, sequence = snapshot
+        if not self.nodes.capacity or generation != self.generation:
+            return
+        for node_id, node in nodes.iteritems():
+            if node_id in self.in_flight or \
+                    self.written_at.get(node_id, -1) > sequence:
+                continue
+            self.nodes.set(node_id, node)
+
+    def writing(self, node_ids):
+        for node_id in node_ids:
+            self.in_flight[node_id] = self.in_flight.get(node_id, 0) + 1
+            self.nodes.discard(node_id)
+
+    def written(self, node_ids):
+        self.sequence += 1
+        for node_id in node_ids:
+            count = self.in_flight.pop(node_id, 1) - 1
+            if count:
+                self.in_flight[node_id] = count
+            self.written_at[node_id] = self.sequence
+            self.nodes.discard(node_id)
+        if len(self.written_at) > self.max_written:
+            # forget the history rather than let it grow: nothing read
+            # before now is stored any more
+            self.written_at.clear()
+            self.nodes.clear()
+            self.generation += 1
+
+    def stats(self):
+        stats = self.nodes.stats()
+        stats["writing"] = len(self.in_flight)
+        return stats
@@ -0,0 +1,116 @@
+from collections import defaultdict
+
+from ysl.util import LRUCache
+
+__all__ = ["ResultCache"]
+
+
+class ResultCache(object):
+    """
+    In-process cache of search results.
+
+    Every manifest has a generation counter which is bumped by writes to
+    its nodes. An entry remembers the generations of the manifests its
+    search can match (all of them when the query is not restricted to
+    some manifests) and is stale as soon as one of them has moved.
+
+    A write bumps generations before it commits, so no snapshot of a
+    manifest it bumped is handed out until it is over: a search running
+    meanwhile could see the old rows under the new generations. Writes
+    get a set from begin(), pass it to bump() and hand it to end() once
+    their transaction is over.
+    """
+
+    def __init__(self, memory):
+        self.entries = LRUCache(memory, sizeof=self._sizeof)
+        self.generations = defaultdict(int)
+        self.generation = 0
+        self.epoch = 0
+        # manifest -> number of writes in flight which bumped it
+        self.writing = defaultdict(int)
+        self.stale = 0
+
+    @staticmethod
+    def _sizeof(entry):
+        # rough estimate of what the result dict costs in memory
+        size = 512
+        for node in entry[1].get("result", ()):
+            size += 280
+            for k, v in node.iteritems():
+                size += 96 + len(k)
+                if isinstance(v, basestring):
+                    size += len(v)
+        for values in entry[1].get("facets", dict()).itervalues():
+            size += 280 * len(values)
+            for value in values:
+                size += len(value["value"] or "")
+        return size
+
+    def snapshot(self, manifests):
+        if not self.entries.capacity:
+            return None
+        return self.version(manifests)
+
+    def version(self, manifests):
+        """
+        What the results of a search restricted to manifests depend on,
+        whether they are cached or not; None while one of them is written.
+        """
+        if manifests is None:
+            if self.writing:
+                return None
+            return (self.epoch, self.generation)
+        if any(map(lambda x: x in self.writing, manifests)):
+            return None
+        return (self.epoch, tuple(map(lambda x: (x, self.generations[x]),
+                                      sorted(manifests))))
+
+    def get(self, key, manifests):
+        entry = self.entries.get(key)
+        if entry is None:
+            return None
+        if entry[0] != self.snapshot(manifests):
+            self.stale += 1
+            self.entries.discard(key)
+            return None
+        return entry[1]
+
+    def put(self, key, snapshot, manifests, result):
+        # a write may have landed while the search was running
+        if snapshot is not None and snapshot == self.snapshot(manifests):
+            self.entries.set(key, (snapshot, result))
+
+    def begin(self):
+        """Start a write, see bump() and end()."""
+        return set()
+
+    def bump(self, manifests=None, write=None):
+        """
+        Invalidate results of the given manifests, or of everything. The
+        manifests bumped by the write begin() returned stay in flight
+        until end().
+        """
+        if manifests is None:
+            self.epoch += 1
+            return
+        for manifest in manifests:
+            self.generations[manifest] += 1
+            if write is not None and manifest not in write:
+                self.writing[manifest] += 1
+                write.add(manifest)
+        self.generation += 1
+
+    def end(self, write):
+        for manifest in write:
+            self.writing[manifest] -= 1
+            if not self.writing[manifest]:
+                del self.writing[manifest]
+
+    def stats(self):
+        stats = self.entries.stats()
+        stats["hits"] -= self.stale
+        stats["stale"] = self.stale
+        lookups = stats["hits"] + stats["misses"] + self.stale
+        stats["ratio"] = float(stats["hits"]) / lookups if lookups else 0.0
+        stats["memory"] = stats.pop("used")
+        return stats
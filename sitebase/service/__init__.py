@@ -5,6 +5,8 @@ from sitebase.service.search import SearchService
 from sitebase.service.setting import SettingService
 from sitebase.service.compare import CompareService
 from sitebase.service.check_syntax import CheckSyntaxService
+from sitebase.service.stats import StatsService
+from sitebase.service.export import ExportService
 
 __all__ = ['site_configure']
 
@@ -17,5 +19,7 @@ def site_configure(c):
     root.putChild(SettingService.serviceName, SettingService(c))
     root.putChild(CompareService.serviceName, CompareService(c))
     root.putChild(CheckSyntaxService.serviceName, CheckSyntaxService(c))
+    root.putChild(StatsService.serviceName, StatsService(c))
+    root.putChild(ExportService.serviceName, ExportService(c))
 
     return root
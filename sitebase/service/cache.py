@@ -7,6 +7,8 @@ from twisted.python.failure import Failure
 
 from sitebase.backend.postgres import dbBackend
 from sitebase.service.error import ArgumentError
+from sitebase import backend
+from sitebase.slex import ParseError
 
 from ysl.twisted.log import debug, info
 
@@ -26,6 +28,8 @@ class CacheService(Resource):
     def getChild(self, name, request):
         if name == 'build':
             return BuildService(self.config)
+        elif name == 'rebuild':
+            return RebuildService(self.config)
         else:
             return self
 
@@ -55,8 +59,8 @@ class CacheService(Resource):
         debug("Request cancelling.")
         call.cancel()
 
-    def select(self, input, node_id):
-        return dbBackend.select_cache(node_id)
+    def select(self, input, node_id, fields):
+        return dbBackend.select_cache(node_id, fields)
 
     def render(self, *args, **kwargs):
         self.startTime = time.time()
@@ -64,13 +68,14 @@ class CacheService(Resource):
 
     def render_GET(self, request):
         node_id = request.path.split("/")[-1]
+        fields = filter(None, request.args.get("fields", [""])[0].split(","))
         d = self.prepare(request)
         request.notifyFinish().addErrback(self.cancel, d)
         try:
             node_id = int(node_id)
         except ValueError:
             raise ArgumentError("id must be integer")
-        d.addCallback(self.select, node_id)
+        d.addCallback(self.select, node_id, fields)
         d.addBoth(self.finish, request)
         return NOT_DONE_YET
 
@@ -129,3 +134,96 @@ class BuildService(Resource):
         d.addCallback(self.build, id)
         d.addBoth(self.finish, request)
         return NOT_DONE_YET
+
+
+class RebuildService(BuildService):
+    """
+    Bulk cache rebuilds: POST starts one, for the nodes of manifest=a,b,
+    for the cached nodes matching q, or for all nodes; GET /<id> reports
+    its progress, GET without id the recent jobs, DELETE /<id> stops it.
+    """
+
+    def _job_id(self, request):
+        try:
+            return request.path.split("/")[3:][0] or None
+        except IndexError:
+            return None
+
+    @staticmethod
+    def _int(job_id):
+        try:
+            return job_id and int(job_id)
+        except ValueError:
+            raise ArgumentError("id must be integer")
+
+    def rebuild(self, input, manifest, q, workers, batch_size):
+        input = input or dict()
+        q = q or input.get("q", u"").encode("UTF-8")
+        manifest = manifest or input.get("manifest")
+        if isinstance(manifest, basestring):
+            manifest = filter(None, manifest.split(","))
+        try:
+            workers = int(workers or input.get("workers", 0))
+            batch_size = int(batch_size or input.get("batch_size", 0))
+        except ValueError:
+            raise ArgumentError("workers or batch_size must be integer")
+        if workers < 0 or batch_size < 0:
+            raise ArgumentError("workers or batch_size must be positive")
+        return dbBackend.rebuild_caches(manifest, q, workers, batch_size)
+
+    def status(self, input, job_id):
+        return dbBackend.rebuild_status(self._int(job_id))
+
+    def stop(self, input, job_id):
+        if job_id is None:
+            raise ArgumentError("id is required")
+        return dbBackend.stop_rebuild(self._int(job_id))
+
+    def finish(self, value, request):
+        request.setHeader('Content-Type', 'application/json; charset=UTF-8')
+        if isinstance(value, Failure):
+            err = value.value
+            request.setResponseCode(500)
+            if isinstance(err, (ArgumentError, backend.ManifestNotFound)):
+                error = dict(error="argument", message=str(err))
+            elif isinstance(err, backend.JobNotFound):
+                request.setResponseCode(404)
+                error = dict(error="not_found", message=str(err))
+            elif isinstance(err, (backend.SearchGrammarError, ParseError)):
+                error = dict(error="syntax", message=str(err))
+            else:
+                error = dict(error="generic", message=str(err))
+            request.write(json_encode(error) + "\n")
+        else:
+            request.setResponseCode(200)
+            request.write(json_encode(value) + "\n")
+
+        log.msg("respone time: %.3fms" % (
+                (time.time() - self.startTime) * 1000))
+        request.finish()
+
+    def render_GET(self, request):
+        d = self.prepare(request)
+        request.notifyFinish().addErrback(self.cancel, d)
+        d.addCallback(self.status, self._job_id(request))
+        d.addBoth(self.finish, request)
+        return NOT_DONE_YET
+
+    def render_POST(self, request):
+        manifest = filter(None,
+                          request.args.get("manifest", [""])[0].split(","))
+        q = request.args.get("q", [None])[0]
+        workers = request.args.get("workers", [None])[0]
+        batch_size = request.args.get("batch_size", [None])[0]
+        d = self.prepare(request)
+        request.notifyFinish().addErrback(self.cancel, d)
+        d.addCallback(self.rebuild, manifest, q, workers, batch_size)
+        d.addBoth(self.finish, request)
+        return NOT_DONE_YET
+
+    def render_DELETE(self, request):
+        d = self.prepare(request)
+        request.notifyFinish().addErrback(self.cancel, d)
+        d.addCallback(self.stop, self._job_id(request))
+        d.addBoth(self.finish, request)
+        return NOT_DONE_YET
@@ -5,7 +5,7 @@ from twisted.internet import defer
 from twisted.python.failure import Failure
 from twisted.internet import threads
 
-from sitebase import backend, slex
+from sitebase import backend
 from sitebase.backend.postgres import dbBackend
 
 from ysl.twisted.log import debug, info
@@ -73,8 +73,7 @@ class CheckSyntaxService(Resource):
         return Resource.render(self, *args, **kwargs)
 
     def check_syntax(self, q):
-        suffix = slex.parse(q)
-        dbBackend._build_where_clause(suffix)
+        dbBackend.compile_query(q)
         return dict(success=True)
 
     def render_GET(self, request):
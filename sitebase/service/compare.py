@@ -6,6 +6,7 @@ from twisted.python.failure import Failure
 
 from sitebase.backend.postgres import dbBackend
 from sitebase import backend
+from sitebase.service.error import ArgumentError
 
 from ysl.twisted.log import debug, info
 
@@ -49,6 +50,8 @@ class CompareService(Resource):
                 request.setResponseCode(400)
             elif isinstance(err, backend.BatchOperationError):
                 request.setResponseCode(400)
+            elif isinstance(err, backend.QueryTimeout):
+                request.setResponseCode(504)
             elif (isinstance(err, Exception) and
                   not isinstance(err, backend.GenericError)):
                 err = dict(error="UnknownError", message=err.message)
@@ -60,8 +63,10 @@ class CompareService(Resource):
         info("respone time: %.3fms" % ((time.time() - self.startTime) * 1000))
         request.finish()
 
-    def cancel(self, err, call):
+    def cancel(self, err, call, guard=None):
         debug("Request cancelling.")
+        if guard is not None:
+            guard.cancel()
         call.cancel()
 
     def select(self, input, node_id):
@@ -71,18 +76,27 @@ class CompareService(Resource):
         self.startTime = time.time()
         return Resource.render(self, *args, **kwargs)
 
-    def compare(self, input):
+    def compare(self, input, timeout, guard):
 
         def _translate(v):
             v["errors"]  = dict(v["errors"])
             return v
-        d = dbBackend.compare(input)
+        try:
+            timeout = timeout and int(timeout)
+        except ValueError:
+            raise ArgumentError("timeout must be integer")
+        if timeout < 0:
+            raise ArgumentError("timeout must not be negative")
+        guard.limit(timeout)
+        d = dbBackend.compare(input, guard=guard)
         d.addCallback(_translate)
         return d
 
     def render_POST(self, request):
+        timeout = request.args.get("timeout", [None])[0]
+        guard = dbBackend.guard()
         d = self.prepare(request)
-        request.notifyFinish().addErrback(self.cancel, d)
-        d.addCallback(self.compare)
+        request.notifyFinish().addErrback(self.cancel, d, guard)
+        d.addCallback(self.compare, timeout, guard)
         d.addBoth(self.finish, request)
         return NOT_DONE_YET
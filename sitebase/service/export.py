@@ -0,0 +1,78 @@
+from twisted.web.server import NOT_DONE_YET
+from twisted.internet import defer
+from twisted.python import log
+
+from sitebase.backend.postgres import dbBackend
+from sitebase.service.error import ArgumentError
+from sitebase.service.search import SearchService
+from sitebase.service.stream import StreamProducer
+
+import time
+
+CONTENT_TYPES = dict(csv="text/csv; charset=UTF-8",
+                     ndjson="application/x-ndjson; charset=UTF-8")
+
+
+class ExportService(SearchService):
+    """
+    Every node matching q as csv or ndjson, streamed from COPY TO STDOUT
+    at the pace of the client. Unlike /search there is no paging and no
+    statement_timeout, exports are expected to take long.
+    """
+
+    isLeaf = True
+    serviceName = "export"
+
+    @defer.inlineCallbacks
+    def export(self, input, request, q, format, fields):
+        if format not in CONTENT_TYPES:
+            raise ArgumentError("format must be csv or ndjson")
+        unknown = filter(lambda x: x.decode("UTF-8", "replace")
+                         not in dbBackend.value_fields, fields)
+        if unknown:
+            raise ArgumentError("unknown fields: %s" % ", ".join(unknown))
+        if not q:
+            q = input["q"].encode("UTF-8")
+
+        producer = StreamProducer(request)
+
+        def consume(data):
+            if not producer.started:
+                producer.start(CONTENT_TYPES[format])
+            return producer.write(data)
+
+        try:
+            total = yield dbBackend.export(q, consume, format, fields)
+        except Exception as e:
+            if not producer.started:
+                raise
+            # headers are gone already, cut the response short so that
+            # the client notices
+            log.msg("export aborted: %s" % str(e))
+            producer.abort()
+            defer.returnValue(None)
+
+        if not producer.started:
+            producer.start(CONTENT_TYPES[format])
+        producer.finish()
+        log.msg("exported %d nodes in %.3fms" % (
+                total, (time.time() - self.startTime) * 1000))
+
+    def render_GET(self, request):
+        q = request.args.get("q", [None])[0]
+        format = request.args.get("format", ["ndjson"])[0]
+        fields = filter(None, request.args.get("fields", [""])[0].split(","))
+        d = self.prepare(request)
+        request.notifyFinish().addErrback(self.cancel, d)
+        d.addCallback(self.export, request, q, format, fields)
+        d.addErrback(self.finish, request)
+        return NOT_DONE_YET
+
+    def render_POST(self, request):
+        format = request.args.get("format", ["ndjson"])[0]
+        fields = filter(None, request.args.get("fields", [""])[0].split(","))
+        d = self.prepare(request)
+        request.notifyFinish().addErrback(self.cancel, d)
+        d.addCallback(self.export, request, None, format, fields)
+        d.addErrback(self.finish, request)
+        return NOT_DONE_YET
@@ -22,15 +22,19 @@ class NodeService(Resource):
         self.debug = c.get("server:main", "debug") == "1"
         Resource.__init__(self, *args, **kwargs)
 
-    def select(self, input, node_id, cascade):
+    def select(self, input, node_id, cascade, timeout, guard):
         try:
             node_id = int(node_id)
+            timeout = timeout and int(timeout)
         except ValueError:
-            raise ArgumentError("id must be integer")
+            raise ArgumentError("id and timeout must be integer")
+        if timeout < 0:
+            raise ArgumentError("timeout must not be negative")
+        guard.limit(timeout)
 
-        return dbBackend.select(node_id, cascade)
+        return dbBackend.select(node_id, cascade, guard)
 
-    def create(self, input, check_only=False):
+    def create(self, input, check_only=False, wait_cache=False):
         if isinstance(input, dict):
             if "manifest" not in input or "value" not in input:
                 raise MalformedInput("manifest or value not specified")
@@ -41,12 +45,14 @@ class NodeService(Resource):
             except ValueError:
                 raise ArgumentError("id must be integer")
 
-            d = dbBackend.create(node_id, input["manifest"], input["value"])
+            d = dbBackend.create(node_id, input["manifest"], input["value"],
+                                 wait_cache=wait_cache)
         else:
-            d = dbBackend.upsert(input, True, check_only=check_only)
+            d = dbBackend.upsert(input, True, check_only=check_only,
+                                 wait_cache=wait_cache)
         return d
 
-    def update(self, input, node_id, check_only=False):
+    def update(self, input, node_id, check_only=False, wait_cache=False):
         if node_id:
             try:
                 node_id = int(node_id)
@@ -54,9 +60,11 @@ class NodeService(Resource):
                 raise ArgumentError("id must be integer")
             if "manifest" not in input or "value" not in input:
                 raise MalformedInput("manifest or value not specified")
-            d = dbBackend.update(node_id, input["manifest"], input["value"])
+            d = dbBackend.update(node_id, input["manifest"], input["value"],
+                                 wait_cache=wait_cache)
         else:
-            d = dbBackend.upsert(input, check_only=check_only)
+            d = dbBackend.upsert(input, check_only=check_only,
+                                 wait_cache=wait_cache)
         return d
 
     def delete(self, input, node_id, cascade):
@@ -95,6 +103,8 @@ class NodeService(Resource):
                 request.setResponseCode(400)
             elif isinstance(err, backend.BatchOperationError):
                 request.setResponseCode(400)
+            elif isinstance(err, backend.QueryTimeout):
+                request.setResponseCode(504)
             elif (isinstance(err, Exception) and
                   not isinstance(err, backend.GenericError)):
                 err = dict(error="UnknownError", message=err.message)
@@ -108,8 +118,10 @@ class NodeService(Resource):
                 (time.time() - self.startTime) * 1000))
         request.finish()
 
-    def cancel(self, err, call):
+    def cancel(self, err, call, guard=None):
         log.msg("Request cancelling.", level=logging.DEBUG)
+        if guard is not None:
+            guard.cancel()
         call.cancel()
 
     def render(self, *args, **kwargs):
@@ -124,25 +136,31 @@ class NodeService(Resource):
 
     def render_PUT(self, request):
         check_only = request.args.get("check_only", [False])[0]
+        wait_cache = request.args.get("wait_cache", ["0"])[0] == "1"
         d = self.prepare(request)
         request.notifyFinish().addErrback(self.cancel, d)
-        d.addCallback(self.create, check_only=check_only)
+        d.addCallback(self.create, check_only=check_only,
+                      wait_cache=wait_cache)
         d.addBoth(self.finish, request)
         return NOT_DONE_YET
 
     def render_POST(self, request):
         check_only = request.args.get("check_only", [False])[0]
+        wait_cache = request.args.get("wait_cache", ["0"])[0] == "1"
         d = self.prepare(request)
         request.notifyFinish().addErrback(self.cancel, d)
-        d.addCallback(self.update, self._id(request), check_only=check_only)
+        d.addCallback(self.update, self._id(request), check_only=check_only,
+                      wait_cache=wait_cache)
         d.addBoth(self.finish, request)
         return NOT_DONE_YET
 
     def render_GET(self, request):
         cascade = request.args.get("cascade", [None])[0]
+        timeout = request.args.get("timeout", [None])[0]
+        guard = dbBackend.guard()
         d = self.prepare(request)
-        request.notifyFinish().addErrback(self.cancel, d)
-        d.addCallback(self.select, self._id(request), cascade)
+        request.notifyFinish().addErrback(self.cancel, d, guard)
+        d.addCallback(self.select, self._id(request), cascade, timeout, guard)
         d.addBoth(self.finish, request)
         return NOT_DONE_YET
 
@@ -7,6 +7,7 @@ from twisted.python.failure import Failure
 
 from sitebase.backend.postgres import dbBackend
 from sitebase.service.error import ArgumentError
+from sitebase.service.stream import StreamProducer
 from sitebase import backend
 from sitebase.slex import ParseError
 
@@ -16,13 +17,23 @@ import logging
 
 class SearchService(Resource):
 
-    isLeaf = True
+    isLeaf = False
     serviceName = "search"
 
     def __init__(self, c, *args, **kwargs):
         Resource.__init__(self, *args, **kwargs)
         self.config = c
 
+    def getChild(self, name, request):
+        if name == 'facets':
+            return FacetService(self.config)
+        elif name == 'batch':
+            return BatchService(self.config)
+        elif name == 'saved':
+            return SavedSearchService(self.config)
+        else:
+            return self
+
     def prepare(self, request):
         request.content.seek(0, 0)
         content = request.content.read()
@@ -31,23 +42,93 @@ class SearchService(Resource):
         else:
             return defer.succeed(None)
 
-    def search(self, input, q, start, num, order_by, order, return_total):
+    @staticmethod
+    def _limit(guard, timeout):
+        try:
+            timeout = timeout and int(timeout)
+        except ValueError:
+            raise ArgumentError("timeout must be integer")
+        if timeout < 0:
+            raise ArgumentError("timeout must not be negative")
+        guard.limit(timeout)
+
+    def search(self, input, q, start, num, order_by, order, return_total,
+               after, fields, timeout, guard):
+        try:
+            start = int(start)
+            num = int(num)
+        except ValueError:
+            raise ArgumentError("start or num must be integer")
+        self._limit(guard, timeout)
+        if not q:
+            q = input["q"].encode("UTF-8")
+        return dbBackend.search(q, start, num, order_by, order, return_total,
+                                after, fields, guard)
+
+    @defer.inlineCallbacks
+    def stream(self, input, request, q, start, num, order_by, order, after,
+               fields, ndjson, timeout, guard):
         try:
             start = int(start)
             num = int(num)
         except ValueError:
             raise ArgumentError("start or num must be integer")
+        self._limit(guard, timeout)
         if not q:
             q = input["q"].encode("UTF-8")
-        return dbBackend.search(q, start, num, order_by, order, return_total)
+
+        producer = StreamProducer(request)
+        content_type = ("application/json; charset=UTF-8",
+                        "application/x-ndjson; charset=UTF-8")[ndjson]
+
+        def consume(nodes):
+            if ndjson:
+                data = "".join(map(lambda x: json_encode(x) + "\n", nodes))
+            elif producer.started:
+                data = "," + ",".join(map(json_encode, nodes))
+            else:
+                data = ('{"start":%d,"result":[' % start
+                        + ",".join(map(json_encode, nodes)))
+            if not producer.started:
+                producer.start(content_type)
+            return producer.write(data)
+
+        try:
+            total = yield dbBackend.search_stream(q, consume, start, num,
+                                                  order_by, order, after,
+                                                  fields, guard=guard)
+        except Exception as e:
+            if not producer.started:
+                raise
+            # headers are gone already, all we can do is to cut the
+            # response short so that the client notices
+            log.msg("stream aborted: %s" % str(e))
+            producer.abort()
+            defer.returnValue(None)
+
+        if not producer.started:
+            producer.start(content_type)
+            if not ndjson:
+                producer.write('{"start":%d,"result":[' % start)
+        if not ndjson:
+            producer.write('],"num":%d}\n' % total)
+        producer.finish()
+        log.msg("respone time: %.3fms" % (
+                (time.time() - self.startTime) * 1000))
 
     def finish(self, value, request):
         request.setHeader('Content-Type', 'application/json; charset=UTF-8')
         if isinstance(value, Failure):
             err = value.value
             request.setResponseCode(500)
-            if isinstance(err, ArgumentError):
+            if isinstance(err, (ArgumentError, backend.InvalidCursor)):
                 error = dict(error="argument", message=str(err))
+            elif isinstance(err, backend.QueryTimeout):
+                request.setResponseCode(504)
+                error = dict(error="timeout", message=str(err))
+            elif isinstance(err, backend.SearchNotFound):
+                request.setResponseCode(404)
+                error = dict(error="not_found", message=str(err))
             elif isinstance(err, backend.SearchGrammarError):
                 error = dict(error="syntax", message=str(err),
                              traceback=value.getTraceback())
@@ -65,8 +146,10 @@ class SearchService(Resource):
                 (time.time() - self.startTime) * 1000))
         request.finish()
 
-    def cancel(self, err, call):
+    def cancel(self, err, call, guard=None):
         log.msg("Request cancelling.", level=logging.DEBUG)
+        if guard is not None:
+            guard.cancel()
         call.cancel()
 
     def render(self, *args, **kwargs):
@@ -80,11 +163,24 @@ class SearchService(Resource):
         order_by = request.args.get("order_by", ["id"])[0]
         order = request.args.get("order", ["asc"])[0]
         return_total = request.args.get("return_total", ["0"])[0]
+        after = request.args.get("after", [None])[0]
+        fields = filter(None, request.args.get("fields", [""])[0].split(","))
+        stream = request.args.get("stream", ["0"])[0] == "1"
+        ndjson = request.args.get("format", ["json"])[0] == "ndjson"
+        timeout = request.args.get("timeout", [None])[0]
+        guard = dbBackend.guard()
         d = self.prepare(request)
-        request.notifyFinish().addErrback(self.cancel, d)
-        d.addCallback(self.search, q, start, num,
-                      order_by, order, return_total)
-        d.addBoth(self.finish, request)
+        request.notifyFinish().addErrback(self.cancel, d, guard)
+        if stream:
+            d.addCallback(self.stream, request, q, start, num,
+                          order_by, order, after, fields, ndjson,
+                          timeout, guard)
+            d.addErrback(self.finish, request)
+        else:
+            d.addCallback(self.search, q, start, num,
+                          order_by, order, return_total, after, fields,
+                          timeout, guard)
+            d.addBoth(self.finish, request)
         return NOT_DONE_YET
 
     def render_POST(self, request):
@@ -93,9 +189,196 @@ class SearchService(Resource):
         order_by = request.args.get("order_by", ["id"])[0]
         order = request.args.get("order", ["asc"])[0]
         return_total = request.args.get("return_total", ["0"])[0]
+        after = request.args.get("after", [None])[0]
+        fields = filter(None, request.args.get("fields", [""])[0].split(","))
+        stream = request.args.get("stream", ["0"])[0] == "1"
+        ndjson = request.args.get("format", ["json"])[0] == "ndjson"
+        timeout = request.args.get("timeout", [None])[0]
+        guard = dbBackend.guard()
+        d = self.prepare(request)
+        request.notifyFinish().addErrback(self.cancel, d, guard)
+        if stream:
+            d.addCallback(self.stream, request, None, start, num,
+                          order_by, order, after, fields, ndjson,
+                          timeout, guard)
+            d.addErrback(self.finish, request)
+        else:
+            d.addCallback(self.search, None, start, num,
+                          order_by, order, return_total, after, fields,
+                          timeout, guard)
+            d.addBoth(self.finish, request)
+        return NOT_DONE_YET
+
+
+class FacetService(SearchService):
+
+    isLeaf = True
+
+    def facets(self, input, q, facets, top, timeout, guard):
+        try:
+            top = int(top)
+        except ValueError:
+            raise ArgumentError("top must be integer")
+        if not facets:
+            raise ArgumentError("no facet field is given")
+        self._limit(guard, timeout)
+        if not q:
+            q = input["q"].encode("UTF-8")
+        return dbBackend.facets(q, facets, top, guard)
+
+    def render_GET(self, request):
+        q = request.args.get("q", [None])[0]
+        facets = filter(None, request.args.get("facets", [""])[0].split(","))
+        top = request.args.get("top", ["0"])[0]
+        timeout = request.args.get("timeout", [None])[0]
+        guard = dbBackend.guard()
+        d = self.prepare(request)
+        request.notifyFinish().addErrback(self.cancel, d, guard)
+        d.addCallback(self.facets, q, facets, top, timeout, guard)
+        d.addBoth(self.finish, request)
+        return NOT_DONE_YET
+
+    def render_POST(self, request):
+        facets = filter(None, request.args.get("facets", [""])[0].split(","))
+        top = request.args.get("top", ["0"])[0]
+        timeout = request.args.get("timeout", [None])[0]
+        guard = dbBackend.guard()
+        d = self.prepare(request)
+        request.notifyFinish().addErrback(self.cancel, d, guard)
+        d.addCallback(self.facets, None, facets, top, timeout, guard)
+        d.addBoth(self.finish, request)
+        return NOT_DONE_YET
+
+
+class BatchService(SearchService):
+
+    isLeaf = True
+
+    def __init__(self, c, *args, **kwargs):
+        SearchService.__init__(self, c, *args, **kwargs)
+        self.max_batch_size = int(c.get("server:main", "max_batch_size"))
+
+    @staticmethod
+    def _query(query):
+        if not isinstance(query, dict) or not query.get("q"):
+            raise ArgumentError("q is required")
+        try:
+            start = int(query.get("start", 0))
+            num = int(query.get("num", 20))
+        except (TypeError, ValueError):
+            raise ArgumentError("start or num must be integer")
+        fields = query.get("fields")
+        if isinstance(fields, basestring):
+            fields = filter(None, fields.split(","))
+        return dict(q=query["q"].encode("UTF-8"), start=start, num=num,
+                    order_by=query.get("order_by", "id"),
+                    order=query.get("order", "asc"),
+                    return_total=str(query.get("return_total", "0")),
+                    after=query.get("after"),
+                    fields=fields or None)
+
+    @staticmethod
+    def _error(err):
+        if isinstance(err, (ArgumentError, backend.InvalidCursor)):
+            return dict(error="argument", message=str(err))
+        else:
+            return dict(error="syntax", message=str(err))
+
+    @defer.inlineCallbacks
+    def search_batch(self, input, timeout, guard):
+        if not isinstance(input, list):
+            raise ArgumentError("a list of queries is expected")
+        if len(input) > self.max_batch_size:
+            raise ArgumentError("at most %d queries in a batch"
+                                % self.max_batch_size)
+        self._limit(guard, timeout)
+
+        queries, errors = list(), dict()
+        for i, query in enumerate(input):
+            try:
+                queries.append(self._query(query))
+            except ArgumentError as e:
+                errors[i] = e
+        found = iter((yield dbBackend.search_batch(queries, guard)))
+
+        result = list()
+        for i in range(len(input)):
+            r = errors[i] if i in errors else next(found)
+            result.append(self._error(r) if isinstance(r, Exception) else r)
+        defer.returnValue(dict(result=result))
+
+    render_GET = None
+
+    def render_POST(self, request):
+        timeout = request.args.get("timeout", [None])[0]
+        guard = dbBackend.guard()
+        d = self.prepare(request)
+        request.notifyFinish().addErrback(self.cancel, d, guard)
+        d.addCallback(self.search_batch, timeout, guard)
+        d.addBoth(self.finish, request)
+        return NOT_DONE_YET
+
+
+class SavedSearchService(SearchService):
+
+    isLeaf = True
+
+    def _name(self, request):
+        try:
+            return request.path.split("/")[3:][0]
+        except:
+            return None
+
+    def select(self, input, name, start, num, fields, timeout, guard):
+        try:
+            start = int(start)
+            num = int(num)
+        except ValueError:
+            raise ArgumentError("start or num must be integer")
+        self._limit(guard, timeout)
+        if not name:
+            return dbBackend.saved_searches()
+        return dbBackend.select_saved(name, start, num, fields, guard)
+
+    def save(self, input, name):
+        if not name:
+            raise ArgumentError("name of the search is required")
+        if not isinstance(input, dict) or not input.get("q"):
+            raise ArgumentError("q is required")
+        return dbBackend.save_search(name, input["q"].encode("UTF-8"),
+                                     input.get("order_by", "id"),
+                                     input.get("order", "asc"))
+
+    def delete(self, input, name):
+        if not name:
+            raise ArgumentError("name of the search is required")
+        return dbBackend.delete_saved_search(name)
+
+    def render_GET(self, request):
+        start = request.args.get("start", ["0"])[0]
+        num = request.args.get("num", ["20"])[0]
+        fields = filter(None, request.args.get("fields", [""])[0].split(","))
+        timeout = request.args.get("timeout", [None])[0]
+        guard = dbBackend.guard()
+        d = self.prepare(request)
+        request.notifyFinish().addErrback(self.cancel, d, guard)
+        d.addCallback(self.select, self._name(request), start, num, fields,
+                      timeout, guard)
+        d.addBoth(self.finish, request)
+        return NOT_DONE_YET
+
+    def render_PUT(self, request):
         d = self.prepare(request)
         request.notifyFinish().addErrback(self.cancel, d)
-        d.addCallback(self.search, None, start, num,
-                      order_by, order, return_total)
+        d.addCallback(self.save, self._name(request))
         d.addBoth(self.finish, request)
         return NOT_DONE_YET
+
+    def render_DELETE(self, request):
+        d = self.prepare(request)
+        request.notifyFinish().addErrback(self.cancel, d)
+        d.addCallback(self.delete, self._name(request))
+        d.addBoth(self.finish, request)
+        return NOT_DONE_YET
+
+    render_POST = None
@@ -0,0 +1,91 @@
+from ujson import decode as json_decode, encode as json_encode
+from twisted.web.resource import Resource
+from twisted.web.server import NOT_DONE_YET
+from twisted.internet import defer
+from twisted.python.failure import Failure
+
+from sitebase.backend.postgres import dbBackend
+from sitebase.service.error import ArgumentError
+
+from ysl.twisted.log import debug, info
+
+import time
+
+
+class StatsService(Resource):
+
+    isLeaf = False
+    serviceName = "stats"
+
+    def __init__(self, c, *args, **kwargs):
+        Resource.__init__(self, *args, **kwargs)
+        self.config = c
+
+    def getChild(self, name, request):
+        if name == 'indexes':
+            return IndexService(self.config)
+        else:
+            return self
+
+    def prepare(self, request):
+        request.content.seek(0, 0)
+        content = request.content.read()
+        if content:
+            return defer.succeed(json_decode(content))
+        else:
+            return defer.succeed(None)
+
+    def finish(self, value, request):
+        request.setHeader('Content-Type', 'application/json; charset=UTF-8')
+        if isinstance(value, Failure):
+            err = value.value
+            request.setResponseCode(500)
+            if isinstance(err, ArgumentError):
+                error = dict(error="argument", message=str(err))
+            else:
+                error = dict(error="generic", message=str(err))
+            request.write(json_encode(error) + "\n")
+        else:
+            request.setResponseCode(200)
+            request.write(json_encode(value) + "\n")
+
+        info("respone time: %.3fms" % ((time.time() - self.startTime) * 1000))
+        request.finish()
+
+    def cancel(self, err, call):
+        debug("Request cancelling.")
+        call.cancel()
+
+    def stats(self, input):
+        return dbBackend.stats()
+
+    def render(self, *args, **kwargs):
+        self.startTime = time.time()
+        return Resource.render(self, *args, **kwargs)
+
+    def render_GET(self, request):
+        d = self.prepare(request)
+        request.notifyFinish().addErrback(self.cancel, d)
+        d.addCallback(self.stats)
+        d.addBoth(self.finish, request)
+        return NOT_DONE_YET
+
+
+class IndexService(StatsService):
+
+    isLeaf = True
+
+    def advise(self, input, min_count):
+        try:
+            min_count = int(min_count)
+        except ValueError:
+            raise ArgumentError("min_count must be integer")
+        return dbBackend.advise_indexes(min_count)
+
+    def render_GET(self, request):
+        min_count = request.args.get("min_count", ["1"])[0]
+        d = self.prepare(request)
+        request.notifyFinish().addErrback(self.cancel, d)
+        d.addCallback(self.advise, min_count)
+        d.addBoth(self.finish, request)
+        return NOT_DONE_YET
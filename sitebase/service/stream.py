@@ -0,0 +1,59 @@
+from zope.interface import implements
+from twisted.internet import defer
+from twisted.internet.interfaces import IPushProducer
+
+
+class StreamProducer(object):
+    """
+    Push producer writing a response in chunks. write() returns a Deferred
+    which fires once the transport wants more data, so whatever feeds the
+    stream follows the pace of the client instead of buffering for it.
+    """
+    implements(IPushProducer)
+
+    def __init__(self, request):
+        self.request = request
+        self.started = False
+        self.paused = False
+        self.stopped = False
+        self.waiting = None
+
+    def start(self, content_type):
+        self.request.setHeader('Content-Type', content_type)
+        self.request.setResponseCode(200)
+        self.request.registerProducer(self, True)
+        self.started = True
+
+    def write(self, data):
+        if self.stopped:
+            return defer.fail(defer.CancelledError("client went away"))
+        self.request.write(data)
+        if not self.paused:
+            return defer.succeed(None)
+        self.waiting = defer.Deferred()
+        return self.waiting
+
+    def finish(self):
+        self.request.unregisterProducer()
+        if not self.stopped:
+            self.request.finish()
+
+    def abort(self):
+        self.request.unregisterProducer()
+        if not self.stopped:
+            self.request.loseConnection()
+
+    def pauseProducing(self):
+        self.paused = True
+
+    def resumeProducing(self):
+        self.paused = False
+        if self.waiting:
+            d, self.waiting = self.waiting, None
+            d.callback(None)
+
+    def stopProducing(self):
+        self.stopped = True
+        if self.waiting:
+            d, self.waiting = self.waiting, None
+            d.errback(defer.CancelledError("client went away"))
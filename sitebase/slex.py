@@ -4,9 +4,11 @@
 # A simple lex parser
 
 from collections import namedtuple
+import re
 
 __all__ = ["parse",
            "lex",
+           "normalize",
            "ParseError",
            "TOKEN_PARENTHESIS",
            "TOKEN_LOGIC",
@@ -47,66 +49,72 @@ class ParseError(Exception):
     pass
 
 
-def lex(q):
-    tokens, i, last, imax = [], 0, 0, len(q)
-
-    def __add_token(q, tokens, last, i, literal=False):
-        t = q[last:i]
-
-        if literal:
-            tokens.append((t, TOKEN_VALUE, last))
-        elif t and t.upper() in LOGIC_OPERS:
-            tokens.append((t.upper(), TOKEN_LOGIC, last))
-        elif t and t[0] in OPCHARS:
-            tokens.append((t, TOKEN_OPER, last))
-        elif t and t[0] in ("(", ")"):
-            tokens.append((t, TOKEN_PARENTHESIS, last))
-        elif t and t.upper() in ("IN"):
-            tokens.append((t, TOKEN_OPER, last))
-        elif t:
-            tokens.append((t, TOKEN_VALUE, last))
-
-        return i
-
-    while i < imax:
-        ch = q[i]
-        if ch in QUOTES:
-
-            last = i = __add_token(q, tokens, last, i) + 1
-
-            # consume chars in quotes
-            while i < imax and q[i] not in QUOTES:
-                i = i + 1
-
-            last = i = __add_token(q, tokens, last, i, True) + 1
-
-        elif ch in WHITESPACES:
+RE_TOKEN = re.compile("|".join((
+    "[%(quotes)s](?P<literal>[^%(quotes)s]*)[%(quotes)s]?",
+    "(?P<space>[%(spaces)s]+)",
+    "(?P<oper>[%(opchars)s]+)",
+    "(?P<paren>[()])",
+    "(?P<word>[^%(quotes)s%(spaces)s%(opchars)s()]+)")) % dict(
+        quotes=re.escape("".join(QUOTES)),
+        spaces=re.escape("".join(WHITESPACES)),
+        opchars=re.escape("".join(OPCHARS))))
 
-            __add_token(q, tokens, last, i)
 
-            # skip whitespaces
-            while i < imax and q[i] in WHITESPACES:
-                i = i + 1
-
-            last = i
-
-        elif ch in OPCHARS:
-
-            last = i = __add_token(q, tokens, last, i)
-
-            # consume potential operators
-            while i < imax and q[i] in OPCHARS:
-                i = i + 1
+def lex(q):
+    """
+    Split q into (token, type, position) tuples in one pass of RE_TOKEN,
+    whose alternatives cover every character. Quoted text is a value,
+    even when empty, and is positioned after its opening quote; an
+    unterminated quote runs to the end of q.
+    """
+    tokens = list()
+    append = tokens.append
+    for m in RE_TOKEN.finditer(q):
+        kind = m.lastgroup
+        if kind == "word":
+            t = m.group()
+            u = t.upper()
+            if u in LOGIC_OPERS:
+                append((u, TOKEN_LOGIC, m.start()))
+            elif u == "IN":
+                append((t, TOKEN_OPER, m.start()))
+            else:
+                append((t, TOKEN_VALUE, m.start()))
+        elif kind == "oper":
+            append((m.group(), TOKEN_OPER, m.start()))
+        elif kind == "literal":
+            append((m.group(kind), TOKEN_VALUE, m.start(kind)))
+        elif kind == "paren":
+            append((m.group(), TOKEN_PARENTHESIS, m.start()))
+    return tokens
 
-            last = __add_token(q, tokens, last, i)
-        elif ch in ("(", ")"):
-            last = __add_token(q, tokens, last, i)
-            last = i = __add_token(q, tokens, last, last + 1)
-        else:
-            i = i + 1
 
-    __add_token(q, tokens, last, i)
-    return tokens
+def normalize(q):
+    """
+    Return a canonical text of the query: whitespace is folded, keywords
+    are upper-cased, values are quoted and the items of an IN list are
+    sorted. Queries which compile to the same search share one form.
+    """
+    output, values, last = list(), list(), None
+
+    def _flush():
+        if values:
+            s = " ".join(values)
+            if last == "IN":
+                s = ",".join(sorted(s.split(",")))
+            output.append('"%s"' % s)
+            del values[:]
+
+    for token, token_type, pos in lex(q):
+        if token_type == TOKEN_VALUE:
+            values.append(token)
+            continue
+        _flush()
+        last = token.upper()
+        output.append(last)
+
+    _flush()
+    return " ".join(output)
 
 
 def parse(q):
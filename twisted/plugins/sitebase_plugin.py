@@ -48,6 +48,21 @@ class SiteBaseServiceMaker(object):
 
         return YAMLConfiguration(field=field, manifest=manifest, cache=cache)
 
+    def tuning(self, c):
+        get = lambda x: c.get("backend:main", x)
+        return dict(plan_cache_size=int(get("plan_cache_size")),
+                    prepare_statements=get("prepare_statements") == "1",
+                    max_prepared_statements=int(
+                        get("max_prepared_statements")),
+                    result_cache_size=int(get("result_cache_size")) << 20,
+                    reference_cache_size=int(get("reference_cache_size")),
+                    statement_timeout=int(get("statement_timeout")),
+                    rebuild_workers=int(get("rebuild_workers")),
+                    rebuild_batch_size=int(get("rebuild_batch_size")),
+                    async_cache=get("async_cache") == "1",
+                    cache_queue_workers=int(get("cache_queue_workers")),
+                    max_exports=int(get("max_exports")))
+
     def makeService(self, options):
 
         from sitebase import configure
@@ -59,7 +74,8 @@ class SiteBaseServiceMaker(object):
         yaml = self.configure(c)
         from sitebase.backend.postgres import dbBackend
         dbBackend.configure(field=yaml.field,
-                            manifest=yaml.manifest, cache=yaml.cache)
+                            manifest=yaml.manifest, cache=yaml.cache,
+                            **self.tuning(c))
         from txpostgres import txpostgres
         txpostgres.ConnectionPool.min = int(c.get("backend:main",
                                                   "max_connections"))
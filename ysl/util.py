@@ -1,8 +1,84 @@
-__all__ = ["match"]
+__all__ = ["match", "LRUCache"]
 
+from collections import OrderedDict
+import itertools
 import re
+import threading
 
 
 def match(p, s):
     m = re.match(p, s)
     return m and setattr(match, "found", m.groups()) == None
+
+
+class LRUCache(object):
+    """
+    A bounded, thread-safe least-recently-used mapping which keeps
+    hit/miss counters. Entries weigh 1 unless a sizeof function is given,
+    in which case capacity is the total weight (e.g. bytes) to keep.
+    """
+
+    def __init__(self, capacity, sizeof=None):
+        self.capacity = capacity
+        self.sizeof = sizeof or (lambda x: 1)
+        self.used = 0
+        self.hits = 0
+        self.misses = 0
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._data)
+
+    def __contains__(self, key):
+        return key in self._data
+
+    def get(self, key, default=None):
+        with self._lock:
+            try:
+                value, weight = self._data.pop(key)
+            except KeyError:
+                self.misses += 1
+                return default
+            self._data[key] = (value, weight)
+            self.hits += 1
+            return value
+
+    def set(self, key, value):
+        weight = self.sizeof(value)
+        with self._lock:
+            self._pop(key)
+            if weight > self.capacity:
+                return
+            self._data[key] = (value, weight)
+            self.used += weight
+            while self.used > self.capacity:
+                key, (value, weight) = self._data.popitem(last=False)
+                self.used -= weight
+
+    def keys(self, limit=None):
+        """Keys from the most recently used one on, at most limit of them."""
+        with self._lock:
+            keys = reversed(self._data.keys())
+            return list(keys if limit is None else
+                        itertools.islice(keys, limit))
+
+    def discard(self, key):
+        with self._lock:
+            self._pop(key)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+            self.used = 0
+
+    def _pop(self, key):
+        if key in self._data:
+            value, weight = self._data.pop(key)
+            self.used -= weight
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return dict(size=len(self._data), capacity=self.capacity,
+                    used=self.used, hits=self.hits, misses=self.misses,
+                    ratio=(float(self.hits) / lookups if lookups else 0.0))